@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+#
+# Measure the wall time of the maestro.py command line (python startup + imports + argparse)
+# using the --help command, which does not touch the database.
+#
+# usage: python3 benchmarks/cli_startup.py --runs 20 --target 300
+#        python3 benchmarks/cli_startup.py --importtime   (show the 15 slowest imports)
+#
+
+import argparse, subprocess, sys, os, time
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--runs', action='store', dest='runs', type=int, default=10,
+                    help = "The number of executions used to compute the median.")
+parser.add_argument('--target', action='store', dest='target', type=float, default=None,
+                    help = "The maximum median time (in ms). Exit with error if the median is above.")
+parser.add_argument('--importtime', action='store_true', dest='importtime', default=False,
+                    help = "Show the slowest imports (python -X importtime).")
+args = parser.parse_args()
+
+
+maestro = os.path.join( os.path.dirname(os.path.abspath(__file__)), '..', 'scripts', 'maestro.py' )
+command = [sys.executable, maestro, '--help']
+
+
+if args.importtime:
+  proc = subprocess.run( [sys.executable, '-X', 'importtime'] + command[1:], stdout=subprocess.DEVNULL,
+                         stderr=subprocess.PIPE, universal_newlines=True )
+  imports = []
+  for line in proc.stderr.split('\n'):
+    if not line.startswith('import time:') or 'cumulative' in line:
+      continue
+    fields = line.split('|')
+    imports.append( (int(fields[1]), fields[2].rstrip()) )
+  for cumulative, name in sorted(imports, reverse=True)[0:15]:
+    print( "%10.1f ms %s" % (cumulative/1000., name) )
+
+
+times = []
+for _ in range(args.runs):
+  start = time.time()
+  subprocess.run( command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True )
+  times.append( (time.time()-start)*1000. )
+
+times.sort()
+median = times[len(times)//2]
+print( "maestro.py --help: median = %1.1f ms, min = %1.1f ms, max = %1.1f ms (%d runs)" % (median, times[0], times[-1], args.runs) )
+
+if args.target and median > args.target:
+  print( "median above the target (%1.1f ms)" % args.target )
+  sys.exit(1)
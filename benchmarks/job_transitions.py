@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+#
+# Compare the time spent to move all jobs of one task to another status using the old path
+# (load all jobs and call setStatus for each one) and the set-based path used by the schedule
+# (one UPDATE statement). Both paths include the final commit.
+#
+# usage: python3 benchmarks/job_transitions.py --jobs 1000 10000 100000
+#
+
+from orchestra.db import OrchestraDB, Worker, Task, Job
+from orchestra import Status, Signal
+from orchestra.Schedule import Schedule
+import argparse, time
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--jobs', action='store', nargs='+', dest='jobs', type=int, default=[1000, 10000, 100000],
+                    help = "The number of jobs into the task for each measurement.")
+parser.add_argument('-u','--url', action='store', dest='url', default='sqlite://',
+                    help = "The database url. Beware, all tables will be created into this database.")
+args = parser.parse_args()
+
+
+
+def populate( db, njobs ):
+
+  from orchestra.db.models import Base
+  engine = db.session().get_bind()
+  Base.metadata.drop_all(engine)
+  Base.metadata.create_all(engine)
+
+  user = Worker( username='bench', email='bench@localhost', volume='' )
+  task = Task( id=0, taskName='user.bench.task', status=Status.TESTING, signal=Signal.WAITING, queueName='cpu' )
+  user.addTask(task)
+  db.session().add(user)
+  db.commit()
+  rows = [ dict( id=idx, taskId=task.id, configId=idx, status=Status.REGISTERED, priority=-1, queueName='cpu',
+                 userId=user.id ) for idx in range(njobs) ]
+  db.session().bulk_insert_mappings( Job, rows )
+  db.commit()
+  return task
+
+
+
+def old_path( db, task ):
+  for job in task.getAllJobs():
+    if job.getStatus() != Status.DONE:
+      job.setPriority(-1)
+      job.setStatus( Status.ASSIGNED )
+  db.commit()
+
+
+
+def new_path( db, task ):
+  schedule.update_jobs( task, {Job.status:Status.ASSIGNED, Job.priority:-1}, exclude=[Status.DONE] )
+  db.commit()
+
+
+
+db = OrchestraDB( args.url )
+schedule = Schedule()
+schedule.setDatabase( db )
+
+print( "%12s %16s %16s" % ("jobs", "old (ms)", "new (ms)") )
+for njobs in args.jobs:
+  elapsed = []
+  for path in [old_path, new_path]:
+    task = populate( db, njobs )
+    start = time.time()
+    path( db, task )
+    elapsed.append( (time.time()-start)*1000 )
+  print( "%12d %16.2f %16.2f" % (njobs, elapsed[0], elapsed[1]) )
+
+db.finalize()
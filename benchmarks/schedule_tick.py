@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+#
+# Measure the time spent by the schedule to run one tick (Schedule.calculate) as a function of
+# the total number of jobs into the database. All tasks are kept in running state with running
+# jobs (with a fresh heartbeat, so none is requeued), so no transition happens and every tick
+# evaluate the same predicates.
+#
+# usage: python3 benchmarks/schedule_tick.py --jobs 1000 10000 100000 --tasks 10
+#
+
+from orchestra.db import OrchestraDB, Worker, Task, Job
+from orchestra import Status, Signal, schedule
+from sqlalchemy import func
+import argparse, time
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--jobs', action='store', nargs='+', dest='jobs', type=int, default=[1000, 10000, 100000],
+                    help = "The total number of jobs into the database for each measurement.")
+parser.add_argument('--tasks', action='store', dest='tasks', type=int, default=10,
+                    help = "The number of tasks used to split the jobs.")
+parser.add_argument('--ticks', action='store', dest='ticks', type=int, default=5,
+                    help = "The number of ticks to be averaged.")
+parser.add_argument('-u','--url', action='store', dest='url', default='sqlite://',
+                    help = "The database url. Beware, all tables will be created into this database.")
+args = parser.parse_args()
+
+
+
+def populate( db, njobs, ntasks ):
+
+  from orchestra.db.models import Base
+  engine = db.session().get_bind()
+  Base.metadata.drop_all(engine)
+  Base.metadata.create_all(engine)
+
+  user = Worker( username='bench', email='bench@localhost', volume='' )
+  db.session().add(user)
+  jobs_per_task = njobs // ntasks
+  for taskId in range(ntasks):
+    task = Task( id=taskId, taskName='user.bench.task_%d'%taskId, status=Status.RUNNING, signal=Signal.WAITING,
+                 queueName='cpu' )
+    user.addTask(task)
+  db.commit()
+
+  rows = [ dict( id=taskId*jobs_per_task+idx, taskId=taskId, configId=idx, status=Status.RUNNING if idx%2 else Status.ASSIGNED,
+                 priority=-1, queueName='cpu', userId=user.id ) for taskId in range(ntasks) for idx in range(jobs_per_task) ]
+  db.session().bulk_insert_mappings( Job, rows )
+  # heartbeat of all running jobs using the database clock (like the pilot)
+  db.session().query(Job).filter( Job.status==Status.RUNNING ).update( {Job.timer:func.now()}, synchronize_session=False )
+  db.commit()
+
+
+
+db = OrchestraDB( args.url )
+schedule.setDatabase( db )
+
+print( "%12s %12s %16s" % ("jobs", "tasks", "tick (ms)") )
+for njobs in args.jobs:
+  populate( db, njobs, args.tasks )
+  start = time.time()
+  for _ in range(args.ticks):
+    schedule.calculate()
+    db.session().expire_all()
+  elapsed = (time.time()-start)/args.ticks
+  if schedule.changes() > 0:
+    print( "WARNING: %d transitions happened during the measurement" % schedule.changes() )
+  print( "%12d %12d %16.2f" % (njobs, args.tasks, elapsed*1000) )
+
+# Time spent by each trigger and transition over all measurements
+print( "\n%50s %10s %16s" % ("trigger/transition", "calls", "total (ms)") )
+for name, (calls, seconds) in sorted( schedule.timers().items(), key=lambda item: -item[1][1] ):
+  print( "%50s %10d %16.2f" % (name, calls, seconds*1000) )
+
+db.finalize()
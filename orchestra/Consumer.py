@@ -4,8 +4,8 @@ __all__ = ["Consumer"]
 
 from Gaugi import Logger, StatusCode
 from Gaugi.messenger.macros import *
-from orchestra import Status, getEnv
-import os, glob, hashlib, sys
+from orchestra import Status, getEnv, getConfig
+import os, glob, hashlib, sys, signal
 
 from subprocess import Popen, PIPE, STDOUT
 
@@ -18,12 +18,18 @@ class Consumer( Logger ):
   def __init__(self, job, slot, db, extra_envs={} ):
     Logger.__init__(self)
     self.__job = job
+    # kept for the heartbeat, so the job is not loaded again from the database
+    self.__jobId = job.id
     self.__db = db
     self.__slot = slot
 
     self.__pending=True
     self.__broken=False
     self.__killed=False
+    # The final status (done or failed) computed once when the process exit
+    self.__answer=None
+    # The process exit is detected by the supervisor
+    self.__supervised=False
 
     # compose the job name
     hash_object = hashlib.md5(str.encode(job.execArgs))
@@ -44,6 +50,10 @@ class Consumer( Logger ):
     return self.__job
 
 
+  def jobId(self):
+    return self.__jobId
+
+
   def slot(self):
     return self.__slot
 
@@ -103,6 +113,28 @@ class Consumer( Logger ):
     self.__killed=True
 
 
+  #
+  # Terminate the process (and its children) now. Used when the job does not belong to this
+  # node anymore, so the status of the job will not be changed.
+  #
+  def stop(self):
+    if self.__proc is None or self.__proc.poll() is not None:
+      return
+    MSG_WARNING( self, "Stopping the job %s (pid %d).", self.__jobname, self.__proc.pid )
+    try:
+      # the command runs inside of a shell
+      with open( '/proc/%d/task/%d/children' % (self.__proc.pid, self.__proc.pid) ) as f:
+        children = [ int(pid) for pid in f.read().split() ]
+    except OSError:
+      children = []
+    for pid in children:
+      try:
+        os.kill( pid, signal.SIGTERM )
+      except OSError:
+        pass
+    self.__proc.terminate()
+
+
   def killed(self):
     return self.__killed
 
@@ -115,8 +147,15 @@ class Consumer( Logger ):
     return self.__pending
 
 
-  def ping(self):
-    self.__job.ping()
+  def pid(self):
+    return self.__proc.pid if self.__proc is not None else None
+
+
+  #
+  # The supervisor will call reap when the process exit. Until there, the consumer is running
+  #
+  def supervise(self):
+    self.__supervised=True
 
 
   #
@@ -130,29 +169,37 @@ class Consumer( Logger ):
       return Status.KILL
     elif self.broken():
       return Status.BROKEN
+    elif self.__answer is not None:
+      return self.__answer
+    elif self.__proc is not None and (self.__supervised or self.__proc.poll() is None):
+      return Status.RUNNING
     else:
+      return self.reap()
 
-      answer = Status.DONE
 
-      if self.__proc is not None:
-        if not  self.__proc.poll() is None:
-          if self.__proc.returncode != 0:
-            answer =  Status.FAILED
-        else:
-          answer =  Status.RUNNING
 
-      if answer == Status.DONE:
-        # Check for any output file into the job directory
-        output = self.job().getTheOutputStoragePath()
+  #
+  # Compute the final status after the process exit. The output directory is checked only once
+  #
+  def reap(self):
+
+    if self.__answer is not None:
+      return self.__answer
+
+    if self.__proc is not None and self.__proc.poll() is None:
+      return Status.RUNNING
+
+    if self.__proc is not None and self.__proc.returncode != 0:
+      self.__answer = Status.FAILED
+    else:
+      # Check for any output file into the job directory
+      output = self.job().getTheOutputStoragePath()
 
-        from orchestra import getConfig
-        config = getConfig()
+      flist = glob.glob(output+"/"+getConfig()["job_complete_file_name"])
+      MSG_INFO(self, "The job with name (%s) finished with %d files into the output directory: %s", self.__jobname, len(flist), output)
+      self.__answer = Status.FAILED if len(flist)==0 else Status.DONE
 
-        flist = glob.glob(output+"/"+config["job_complete_file_name"])
-        MSG_INFO(self, "The job with name (%s) finished with %d files into the output directory: %s", self.__jobname, len(flist), output)
-        return Status.FAILED if len(flist)==0 else Status.DONE
-      else:
-        return answer
+    return self.__answer
 
 
 
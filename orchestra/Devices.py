@@ -0,0 +1,207 @@
+
+__all__ = ["Device", "DeviceDiscovery"]
+
+
+from Gaugi import Logger
+from Gaugi.messenger.macros import *
+from orchestra.utils import getConfig
+import os, time, json, subprocess
+
+
+#
+# One GPU device. Memory in MiB and utilization in percent (None when unknown)
+#
+class Device(object):
+
+  def __init__(self, index, name='', memory_total=None, memory_used=None, utilization=None):
+    self.__index = index
+    self.__name = name
+    self.__memory_total = memory_total
+    self.__memory_used = memory_used
+    self.__utilization = utilization
+
+  def index(self):
+    return self.__index
+
+  def name(self):
+    return self.__name
+
+  def memoryTotal(self):
+    return self.__memory_total
+
+  def memoryUsed(self):
+    return self.__memory_used
+
+  def memoryFree(self):
+    if self.__memory_total is None or self.__memory_used is None:
+      return None
+    return self.__memory_total - self.__memory_used
+
+  def utilization(self):
+    return self.__utilization
+
+  def update(self, memory_used, utilization):
+    self.__memory_used = memory_used
+    self.__utilization = utilization
+
+  def __str__(self):
+    return "GPU %d (%s, %s/%s MiB, %s%%)" % (self.__index, self.__name, self.__memory_used,
+                                           self.__memory_total, self.__utilization)
+
+
+
+
+#
+# Find the GPU devices of this node without any framework (tensorflow, torch). The backends
+# are tried in this order:
+#
+#   config     : "gpus" key in the orchestra config or ORCHESTRA_GPUS env. Can be the number
+#                of devices ("2"), a list of indices ("0,1" or [0,1]) or a list of dicts with
+#                index, name and memory (MiB) keys (json in the env).
+#   nvidia-smi : query the index, name, memory and utilization of each device.
+#   proc       : read /proc/driver/nvidia/gpus (index and name only).
+#
+class DeviceDiscovery( Logger ):
+
+  proc_path = '/proc/driver/nvidia/gpus'
+
+  smi_command = ['nvidia-smi', '--query-gpu=index,name,memory.total,memory.used,utilization.gpu',
+                 '--format=csv,noheader,nounits']
+
+  #
+  # Constructor
+  #
+  def __init__(self, max_age=5.):
+    Logger.__init__(self)
+    self.__devices = []
+    self.__backend = None
+    # minimal time (in seconds) between two nvidia-smi calls in update
+    self.__max_age = max_age
+    self.__updated = None
+
+
+  def backend(self):
+    return self.__backend
+
+
+  def devices(self):
+    return self.__devices
+
+
+  def device(self, index):
+    for device in self.__devices:
+      if device.index() == index:
+        return device
+    return None
+
+
+  #
+  # Find all devices using the first backend with answer
+  #
+  def discover(self):
+    for backend, method in [ ('config', self.__fromConfig), ('nvidia-smi', self.__fromSmi), ('proc', self.__fromProc) ]:
+      try:
+        devices = method()
+      except Exception as e:
+        MSG_WARNING( self, "GPU discovery using %s failed: %s", backend, e )
+        devices = None
+      if devices is not None:
+        self.__devices = devices
+        self.__backend = backend
+        self.__updated = time.time()
+        MSG_INFO( self, "Found %d GPU devices using %s", len(devices), backend )
+        for device in devices:
+          MSG_DEBUG( self, str(device) )
+        return devices
+    self.__devices = []
+    self.__backend = None
+    return self.__devices
+
+
+  #
+  # Update the memory and utilization of each device. Only possible with nvidia-smi
+  #
+  def update(self, force=False):
+    if self.__backend != 'nvidia-smi':
+      return False
+    now = time.time()
+    if not force and self.__updated and (now - self.__updated) < self.__max_age:
+      return False
+    self.__updated = now
+    try:
+      devices = self.__fromSmi()
+    except Exception as e:
+      MSG_WARNING( self, "Not possible to update the GPU devices: %s", e )
+      return False
+    for device in devices or []:
+      _device = self.device( device.index() )
+      if _device:
+        _device.update( device.memoryUsed(), device.utilization() )
+    return True
+
+
+  #
+  # Static list from the config file or env
+  #
+  def __fromConfig(self):
+    try:
+      gpus = getConfig()['gpus']
+    except KeyError:
+      return None
+    if gpus is None:
+      return None
+    if isinstance(gpus, str):
+      gpus = gpus.strip()
+      gpus = json.loads(gpus) if gpus.startswith('[') else [int(idx) for idx in gpus.split(',') if idx.strip()] if ',' in gpus else int(gpus)
+    if isinstance(gpus, int):
+      gpus = list(range(gpus))
+    devices = []
+    for gpu in gpus:
+      if isinstance(gpu, dict):
+        devices.append( Device( int(gpu['index']), gpu.get('name', ''), gpu.get('memory'), 0 if gpu.get('memory') else None ) )
+      else:
+        devices.append( Device( int(gpu) ) )
+    return devices
+
+
+  #
+  # Query the devices using nvidia-smi. Return None if not installed
+  #
+  def __fromSmi(self):
+    try:
+      output = subprocess.check_output( self.smi_command, stderr=subprocess.DEVNULL, universal_newlines=True, timeout=10 )
+    except FileNotFoundError:
+      return None
+    devices = []
+    for line in output.strip().split('\n'):
+      if not line.strip():
+        continue
+      index, name, total, used, utilization = [ field.strip() for field in line.split(',') ]
+      devices.append( Device( int(index), name, self.__number(total), self.__number(used), self.__number(utilization) ) )
+    return devices
+
+
+  #
+  # Read the devices from the nvidia driver. Return None if the driver is not loaded
+  #
+  def __fromProc(self):
+    if not os.path.isdir( self.proc_path ):
+      return None
+    devices = []
+    for bus in sorted(os.listdir( self.proc_path )):
+      info = {}
+      with open( os.path.join( self.proc_path, bus, 'information' ) ) as f:
+        for line in f:
+          if ':' in line:
+            key, value = line.split(':', 1)
+            info[key.strip()] = value.strip()
+      devices.append( Device( int(info.get('Device Minor', len(devices))), info.get('Model', '') ) )
+    return sorted( devices, key=lambda device: device.index() )
+
+
+  # nvidia-smi answer [N/A] for unsupported fields
+  def __number( self, value ):
+    try:
+      return float(value)
+    except ValueError:
+      return None
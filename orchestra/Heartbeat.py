@@ -0,0 +1,46 @@
+
+__all__ = ["Heartbeat"]
+
+
+from Gaugi import Logger
+from Gaugi.messenger.macros import *
+from orchestra.utils import Clock
+
+
+#
+# Aggregate the heartbeats of one node. All jobs running into the node (and the node itself)
+# are pinged using one UPDATE each per interval, instead of one write per job for each tick.
+# The caller is responsible to commit.
+#
+class Heartbeat( Logger ):
+
+  #
+  # Constructor
+  #
+  def __init__(self, db, nodename, interval=10.):
+    Logger.__init__(self)
+    self.__db = db
+    self.__nodename = nodename
+    self.__clock = Clock( interval )
+
+
+  #
+  # Seconds until the next beat
+  #
+  def remaining(self):
+    return self.__clock.remaining()
+
+
+  #
+  # Ping all these jobs and the node if the interval expired (or force). Return True if pinged
+  #
+  def beat(self, ids, force=False):
+    if not force and self.__clock.remaining() > 0:
+      return False
+    self.__clock.reset()
+    njobs = self.__db.pingJobs( ids, self.__nodename )
+    self.__db.pingNode( self.__nodename )
+    if njobs < len(ids):
+      MSG_DEBUG( self, "%d jobs are not running into %s anymore (or not started yet)", len(ids)-njobs, self.__nodename )
+    MSG_DEBUG( self, "Heartbeat for %s with %d jobs", self.__nodename, njobs )
+    return True
@@ -6,6 +6,9 @@ from Gaugi import Logger, StatusCode
 from Gaugi.messenger.macros import *
 from orchestra.enums import *
 from orchestra.utils import Clock
+from orchestra.Heartbeat import Heartbeat
+from sqlalchemy.exc import DBAPIError
+import time
 
 SECONDS = 1.
 
@@ -15,7 +18,9 @@ class Pilot(Logger):
   #
   # Constructor
   #
-  def __init__(self, node, db, schedule,  postman, master=True):
+  def __init__(self, node, db, schedule,  postman, master=True, event_driven=False,
+                     interval=10*SECONDS, min_interval=1*SECONDS, max_interval=30*SECONDS,
+                     heartbeat_interval=10*SECONDS, reconnect_interval=10*SECONDS ):
 
     Logger.__init__(self)
     self.__node = node
@@ -25,7 +30,17 @@ class Pilot(Logger):
     self.__queue = {}
 
     self.__master = master
-    self.__clock = Clock( 10*SECONDS )
+    # The tick interval is shortened when there are jobs waiting for free slots and it
+    # will backoff (until max_interval) when there is nothing to do.
+    self.__clock = Clock( interval, min_interval, max_interval )
+    # Wake up when something change into the database instead of polling
+    self.__event_driven = event_driven
+    # Ping all running jobs and the node in one round per interval, even if the tick backoff
+    self.__heartbeat = Heartbeat( db, node.getName(), heartbeat_interval )
+    # Wait before reconnect in case of database failure
+    self.__reconnect_interval = reconnect_interval
+    # Time spent (in seconds) by each phase of the last tick
+    self.__timers = { 'schedule':0., 'claim':0., 'execute':0., 'commit':0. }
 
 
   def __add__( self, slots ):
@@ -45,18 +60,89 @@ class Pilot(Logger):
       if slots.initialize().isFailure():
         MSG_FATAL( self, "Not possible to initialize the %s slot for %s node. abort", queue, self.__node.name )
 
+    if self.__event_driven and not self.__db.listen():
+      MSG_WARNING( self, "Not possible to listen the database. The pilot will wake up every %d seconds.", self.__clock.interval() )
+
+    # tell to the database that this node is running (alive)
+    self.__heartbeat.beat( [], force=True )
+    self.__db.commit()
+
     return StatusCode.SUCCESS
 
 
 
   def execute(self):
 
-    while self.alive():
+    while True:
+
+      try:
+        if not self.alive():
+          break
+
+        # Wake up for the next tick or for the next heartbeat (whichever comes first). The exit
+        # of one running job wakes up the pilot too
+        fds = self.fds()
+        if self.__event_driven:
+          # Block until something change into the database or the next deadline
+          notified = len( self.__db.wait( min( self.__clock.remaining(), self.__heartbeat.remaining() ), fds ) ) > 0
+        else:
+          # Sleep until the next deadline
+          notified = self.__clock.wait( self.__heartbeat.remaining(), fds )
+
+        # Many changes (including the commit of this pilot) come in bursts. Collect all of them
+        # until the shortest tick interval since the last tick, so they are handled in one tick.
+        # The exited jobs are not watched here, since they stay ready until reaped by the tick
+        cooldown = self.__clock.cooldown() if notified else 0
+        while cooldown > 0:
+          if self.__event_driven:
+            self.__db.wait( cooldown )
+          else:
+            time.sleep( cooldown )
+          cooldown = self.__clock.cooldown()
+
+        if notified or self.__clock.remaining() == 0:
+          self.tick()
+          self.__clock.reset()
+        elif self.__heartbeat.beat( self.jobs() ):
+          self.__db.commit()
+
+      except DBAPIError as e:
+        # The database is not reachable. Keep the jobs running and try again later
+        MSG_ERROR( self, "Database failure: %s. Reconnecting in %d seconds...", e, self.__reconnect_interval )
+        time.sleep( self.__reconnect_interval )
+        self.__db.reconnect()
+
+    return StatusCode.SUCCESS
+
+
+
+  #
+  # Run the schedule (master only) and retrieve the jobs for all available slots
+  #
+  def tick(self):
+
+    timers = { 'schedule':0., 'claim':0., 'execute':0., 'commit':0. }
+    # There are more assigned jobs than free slots
+    busy = False
+    # There is nothing to schedule, to claim or to execute
+    idle = True
 
-      if self.__clock():
+    # The jobs claimed by this tick (the row of these jobs will be back to the queue if the
+    # transaction is not committed)
+    claimed = []
+
+    # All changes of this tick (transitions, claims, slot changes and heartbeats) will be
+    # committed in a single transaction at the end of the block
+    try:
+      with self.__db.unit_of_work() as uow:
 
         if self.__master:
+          start = time.time()
           self.__schedule.execute()
+          timers['schedule'] = time.time() - start
+          # The schedule still has work to do
+          if self.__schedule.changes() > 0:
+            idle = False
 
         # If in standalone mode, these slots will not in running mode. Only schedule will run.
         for queue , slots in self.__queue.items():
@@ -65,16 +151,81 @@ class Pilot(Logger):
             njobs = slots.size() - slots.allocated()
 
             MSG_DEBUG(self,"There are slots available. Retrieving the first %d jobs from the CPU queue",njobs )
-            jobs = self.__schedule.getQueue(njobs, queue)
+            start = time.time()
+            jobs = self.__schedule.getQueue(njobs, queue, self.__node.getName())
+            timers['claim'] += time.time() - start
+            if njobs > 0 and len(jobs) == njobs:
+              busy = True
+            claimed.extend( [ job.id for job in jobs ] )
 
             while (slots.isAvailable()) and len(jobs)>0:
               slots.push_back( jobs.pop() )
 
+          start = time.time()
           slots.execute()
+          timers['execute'] += time.time() - start
+          if not slots.empty():
+            idle = False
 
-        self.__clock.reset()
+        start = time.time()
+        self.__heartbeat.beat( self.jobs() )
 
-    return StatusCode.SUCCESS
+    except Exception:
+      # Nothing was committed, so the jobs claimed by this tick can be dispatched by other node
+      self.release( claimed )
+      raise
+
+    # The claims lost to other nodes while the transaction was replayed
+    self.release( [ identity[0] for identity in uow.dropped( 'job' ) ] )
+
+    timers['commit'] = time.time() - start
+    self.__timers = timers
+
+    if busy:
+      self.__clock.speedup()
+    elif idle:
+      self.__clock.backoff()
+    else:
+      self.__clock.restore()
+
+    MSG_DEBUG( self, "Tick (next in %1.1f seconds): schedule = %1.3f, claim = %1.3f, execute = %1.3f, commit = %1.3f",
+               self.__clock.interval(), timers['schedule'], timers['claim'], timers['execute'], timers['commit'] )
+
+
+
+  #
+  # Time spent (in seconds) by each phase (schedule, claim, execute and commit) of the last tick
+  #
+  def timers(self):
+    return self.__timers
+
+
+
+  #
+  # The pidfd of all running jobs into this node
+  #
+  def fds(self):
+    return [ fd for slots in self.__queue.values() for fd in slots.fds() ]
+
+
+
+  #
+  # Stop the consumers of these jobs (not allocated to this node anymore)
+  #
+  def release(self, ids):
+    if not ids:
+      return
+    MSG_WARNING( self, "The jobs %s are not allocated to this node anymore. Stopping...", ids )
+    for slots in self.__queue.values():
+      slots.release( ids )
+
+
+
+  #
+  # The id of all jobs allocated into this node
+  #
+  def jobs(self):
+    return [ id for slots in self.__queue.values() for id in slots.jobs() ]
 
 
 
@@ -84,6 +235,9 @@ class Pilot(Logger):
     self.__schedule.finalize()
     for queue , slots in self.__queue.items():
       slots.finalize()
+    # deliver all notifications still in the queue
+    if self.__postman:
+      self.__postman.finalize()
     return StatusCode.SUCCESS
 
 
@@ -103,8 +257,7 @@ class Pilot(Logger):
       self.__node.setSignal('waiting')
       return False
     else:
-      # tell to the database that this node is running (alive)
-      self.__node.ping()
+      # the node heartbeat is sent together with the jobs heartbeat
       return True
 
 
@@ -5,10 +5,11 @@ __all__ = ["schedule"]
 from Gaugi import Logger, StatusCode
 from Gaugi.messenger.macros import *
 
-from sqlalchemy import and_, or_, desc
+from sqlalchemy import and_, or_, desc, func
 
 from orchestra.enums import *
 from orchestra.db.models import *
+from orchestra.utils import getConfig
 
 import time
 
@@ -21,9 +22,17 @@ class Schedule(Logger):
   #
   # Constructor
   #
-  def __init__(self):
+  def __init__(self, only_active_tasks=True):
     Logger.__init__(self)
     self.__states = []
+    # Transitions compiled by source state with the triggers already bound to this schedule
+    self.__transitions = {}
+    # Number of calls and time spent (in seconds) by each trigger and transition
+    self.__timers = {}
+    self.__histogram = None
+    self.__only_active_tasks = only_active_tasks
+    # Number of transitions and requeued jobs in the last execute
+    self.__changes = 0
 
 
   def setDatabase(self, db):
@@ -54,12 +63,19 @@ class Schedule(Logger):
   #
   def execute(self):
 
-    self.treatRunningJobsNotAlive()
+    self.__changes = len( self.treatRunningJobsNotAlive() )
     self.calculate()
     self.db().commit()
     return StatusCode.SUCCESS
 
 
+  #
+  # Number of transitions and requeued jobs in the last execute (0 if there was nothing to do)
+  #
+  def changes(self):
+    return self.__changes
+
+
   #
   # finalize
   #
@@ -68,31 +84,104 @@ class Schedule(Logger):
 
 
   #
-  # run state machine for eacj task
+  # run state machine for eacj task. If the jobs can not be counted, the error is raised and
+  # no task will change its state in this tick
   #
   def calculate(self):
 
-    for user in self.db().getAllUsers():
-      for task in user.getAllTasks():
-        self.run(task)
+    if self.__only_active_tasks:
+      # Only tasks that can change its state will be loaded (with the user) in one query.
+      tasks = self.db().getAllActiveTasks()
+      # Count all jobs by task and status once per tick. All triggers will read from here
+      self.__histogram = self.db().getJobStatusHistogram( [task.id for task in tasks] ) if tasks else {}
+    else:
+      tasks = [ task for user in self.db().getAllUsers() for task in user.getAllTasks() ]
+      self.__histogram = self.db().getJobStatusHistogram()
+
+    # Group the tasks by state to look up the transitions only once per state
+    states = {}
+    for task in tasks:
+      states.setdefault( task.getStatus(), [] ).append( task )
+
+    try:
+      for state, _tasks in states.items():
+        MSG_INFO( self,  "Current status is: %s (%d tasks)", state, len(_tasks) )
+        transitions = self.__transitions.get( state, [] )
+        for task in _tasks:
+          if self.__run( task, transitions ):
+            self.__changes += 1
+    finally:
+      self.__histogram = None
+
+    # Keep the task summary (used by the task list) up to date, including the tasks that
+    # reached a final state in this tick
+    if tasks:
+      self.db().updateTaskSummaries( tasks, self.db().getJobStatusHistogram( [task.id for task in tasks] ) )
     return StatusCode.SUCCESS
 
 
   #
-  # Get the list of jobs ordered by the priority for CPU
+  # Count the number of jobs into this task with one of these status (all jobs if None)
   #
-  def getQueue( self, njobs , queuename):
+  def count( self, task, status=None ):
+
+    if self.__histogram is None:
+      # Called outside of the tick. Ask to the database only for this task
+      histogram = self.db().getJobStatusHistogram( [task.id] ).get( task.id, {} )
+    else:
+      histogram = self.__histogram.get( task.id, {} )
+
+    if status is None:
+      return sum( histogram.values() )
+    if type(status) is not list:
+      status = [status]
+    return sum( [histogram.get(s, 0) for s in status] )
+
+
+  #
+  # Change the jobs of this task using one UPDATE statement. Only jobs with one of the status
+  # in include (or all jobs if None) and none of the status in exclude will be changed.
+  # Return the number of changed jobs.
+  #
+  def update_jobs( self, task, values, include=None, exclude=None ):
+    query = self.db().session().query(Job).filter( Job.taskId==task.id )
+    if include:
+      query = query.filter( Job.status.in_(include) )
+    if exclude:
+      query = query.filter( Job.status.notin_(exclude) )
+    # evaluate will keep any job already loaded into the session (e.g. slots) synchronized
+    return query.update( values, synchronize_session='evaluate' )
+
+
+  #
+  # Get the first job of the task (used to test) without load all jobs
+  #
+  def first_job( self, task ):
+    return self.db().session().query(Job).filter( Job.taskId==task.id ).order_by(Job.id).first()
+
+
+  #
+  # Claim the next jobs (ordered by the priority) from the queue for this node. Rows locked by
+  # other pilots are skipped and the claimed jobs are moved to pending in the same transaction,
+  # so the same job can not be dispatched twice.
+  #
+  def getQueue( self, njobs , queuename, nodename=None):
     try:
-      #jobs = self.db().session().query(Job).filter(  and_( Job.status==Status.ASSIGNED ,
-      #  Job.queueName==queuename) ).order_by(Job.id).limit(njobs).with_for_update().all()
- 
-      jobs = self.db().session().query(Job).filter(  Job.status==Status.ASSIGNED  ).order_by(Job.id).limit(njobs).with_for_update().all()
+      jobs = self.db().session().query(Job).filter(  and_( Job.status==Status.ASSIGNED ,
+        Job.queueName==queuename) ).order_by(desc(Job.priority), Job.id).limit(njobs).with_for_update(skip_locked=True).all()
 
+      for job in jobs:
+        job.setStatus( Status.PENDING )
+        job.setNodeName( nodename )
+        # use the database clock as the heartbeat
+        job.timer = func.now()
+      self.db().commit()
 
       jobs.reverse()
       return jobs
     except Exception as e:
       MSG_ERROR(self,e)
+      self.db().rollback()
       return []
 
 
@@ -101,7 +190,7 @@ class Schedule(Logger):
   #
   def getAllRunningJobs(self):
     try:
-      return self.db().session().query(Job).filter( and_( Job.status==Status.RUNNING) ).with_for_update().all()
+      return self.db().session().query(Job).filter( and_( Job.status==Status.RUNNING) ).all()
     except Exception as e:
       MSG_ERROR(self,e)
       return []
@@ -113,33 +202,68 @@ class Schedule(Logger):
   # Execute the correct state machine for this task
   #
   def run(self, task):
+    return self.__run( task, self.__transitions.get( task.getStatus(), [] ) )
+
+
+  #
+  # Run the triggers of each transition (in the order that they were added) until one pass.
+  # Return True if the task changed its state
+  #
+  def __run(self, task, transitions):
 
-    # Get the current state information
-    current_state = task.getStatus()
-    # Run all state triggers to find the correct transiction
-    for source, triggers, destination in self.__states:
-
-      # Check if the current state is equal than this state
-      if source == current_state:
-        passed = True
-        MSG_INFO( self,  "Current status is: %s"%current_state )
-        # Execute all triggers into this state
-        for trigger in triggers:
-          passed = getattr(self, trigger)(task)
-          #MSG_INFO(self, trigger +  ' = ' + str(passed) )
-          if not passed:
-            break
-        if passed:
-          task.setStatus( destination )
+    for name, triggers, destination in transitions:
+      passed = True
+      start = time.time()
+      # Execute all triggers into this state
+      for trigger, callback in triggers:
+        _start = time.time()
+        passed = callback(task)
+        self.__count( trigger, time.time() - _start )
+        if not passed:
           break
+      self.__count( name, time.time() - start )
+      if passed:
+        task.setStatus( destination )
+        return True
+    return False
+
+
+  def __count( self, name, seconds ):
+    timer = self.__timers.get( name )
+    if timer is None:
+      self.__timers[name] = [1, seconds]
+    else:
+      timer[0]+=1; timer[1]+=seconds
 
 
+  #
+  # Number of calls and time spent (in seconds) by each trigger and transition (source->destination)
+  #
+  def timers(self):
+    return { name : tuple(timer) for name, timer in self.__timers.items() }
+
+
+  def resetTimers(self):
+    self.__timers = {}
+
+
+  #
+  # Move the running jobs without heartbeat back to the queue. The check runs into the database
+  # (only the id of the requeued jobs are returned), with one threshold for each queue listed in
+  # queue_heartbeat_timeout and job_heartbeat_timeout for all other queues.
+  #
   def treatRunningJobsNotAlive(self):
 
-    jobs = self.getAllRunningJobs()
-    for job in jobs:
-      if not job.isAlive():
-        job.setStatus( Status.ASSIGNED )
+    config = getConfig()
+    timeouts = config['queue_heartbeat_timeout']
+    ids = []
+    for queuename, timeout in timeouts.items():
+      ids.extend( self.db().requeueStaleJobs( timeout, [queuename] ) )
+    ids.extend( self.db().requeueStaleJobs( config['job_heartbeat_timeout'], list(timeouts.keys()), exclude=True ) if timeouts else
+                self.db().requeueStaleJobs( config['job_heartbeat_timeout'] ) )
+    if ids:
+      MSG_WARNING( self, "%d running jobs without heartbeat were moved back to the queue: %s", len(ids), ids )
+    return ids
 
 
 
@@ -150,6 +274,9 @@ class Schedule(Logger):
     if type(trigger) is not list:
       trigger=[trigger]
     self.__states.append( (source, trigger, destination) )
+    # Bind all triggers now. An unknown trigger name will fail here and not in the tick
+    triggers = [ (name, getattr(self, name)) for name in trigger ]
+    self.__transitions.setdefault( source, [] ).append( ('%s->%s'%(source, destination), triggers, destination) )
 
 
 
@@ -160,8 +287,7 @@ class Schedule(Logger):
   def broken_all_jobs( self, task ):
 
     try:
-      for job in task.getAllJobs():
-        job.setStatus( Status.BROKEN )
+      self.update_jobs( task, {Job.status:Status.BROKEN} )
       task.setSignal( Signal.WAITING )
       return True
     except Exception as e:
@@ -178,8 +304,7 @@ class Schedule(Logger):
 
     try:
       if task.getSignal() == Signal.RETRY:
-        for job in task.getAllJobs():
-          job.setStatus( Status.REGISTERED )
+        self.update_jobs( task, {Job.status:Status.REGISTERED} )
         task.setSignal( Signal.WAITING )
         return True
       else:
@@ -200,10 +325,7 @@ class Schedule(Logger):
       user = task.getUser()
 
       if task.getSignal() == Signal.RETRY:
-        for job in task.getAllJobs():
-          if job.getStatus() == Status.FAILED:
-            job.setPriority(1000)
-            job.setStatus( Status.ASSIGNED )
+        self.update_jobs( task, {Job.status:Status.ASSIGNED, Job.priority:1000}, include=[Status.FAILED] )
         task.setSignal( Signal.WAITING )
         return True
       else:
@@ -223,11 +345,9 @@ class Schedule(Logger):
 
     try:
       if task.getSignal() == Signal.KILL:
-        for job in task.getAllJobs():
-          if job.getStatus() != Status.RUNNING:
-            job.setStatus( Status.KILLED )
-          else:
-            job.setStatus( Status.KILL )
+        # The running jobs must be killed by the slots first
+        self.update_jobs( task, {Job.status:Status.KILLED}, exclude=[Status.RUNNING] )
+        self.update_jobs( task, {Job.status:Status.KILL}, include=[Status.RUNNING] )
         task.setSignal( Signal.WAITING )
         return True
       else:
@@ -246,8 +366,7 @@ class Schedule(Logger):
   def all_jobs_were_killed( self, task ):
 
     try:
-      total = len(self.db().session().query(Job).filter( Job.taskId==task.id ).all())
-      if ( len(self.db().session().query(Job).filter( and_ ( Job.taskId==task.id, Job.status==Status.KILLED ) ).all()) == total ):
+      if self.count( task, Status.KILLED ) == self.count( task ):
         return True
       else:
         return False
@@ -265,7 +384,7 @@ class Schedule(Logger):
 
     try:
       # Get the first job from the list of jobs into this task
-      job = task.getAllJobs()[0]
+      job = self.first_job( task )
       if job.getStatus() == Status.DONE:
         return True
       else:
@@ -284,7 +403,7 @@ class Schedule(Logger):
 
     try:
       # Get the first job from the list of jobs into this task
-      job = task.getAllJobs()[0]
+      job = self.first_job( task )
       if job.getStatus() == Status.RUNNING:
         return True
       else:
@@ -302,7 +421,7 @@ class Schedule(Logger):
 
     try:
       # Get the first job from the list of jobs into this task
-      job = task.getAllJobs()[0]
+      job = self.first_job( task )
       if job.getStatus() == Status.FAILED or job.getStatus() == Status.BROKEN:
         return True
       else:
@@ -320,8 +439,7 @@ class Schedule(Logger):
   def all_jobs_are_registered( self, task ):
 
     try:
-      total = len(self.db().session().query(Job).filter( Job.taskId==task.id ).all())
-      if len(self.db().session().query(Job).filter( and_ ( Job.taskId==task.id, Job.status==Status.REGISTERED ) ).all()) == total:
+      if self.count( task, Status.REGISTERED ) == self.count( task ):
         return True
       else:
         return False
@@ -342,7 +460,7 @@ class Schedule(Logger):
       user = task.getUser()
       priority = 1000
       # Get the first job from the list of jobs into this task
-      job = task.getAllJobs()[0]
+      job = self.first_job( task )
       job.setPriority( priority )
       job.setStatus( Status.ASSIGNED )
       return True
@@ -359,10 +477,7 @@ class Schedule(Logger):
   def assigned_all_jobs( self, task ):
 
     try:
-      for job in task.getAllJobs():
-        if job.getStatus() != Status.DONE:
-          job.setPriority(-1)
-          job.setStatus( Status.ASSIGNED )
+      self.update_jobs( task, {Job.status:Status.ASSIGNED, Job.priority:-1}, exclude=[Status.DONE] )
       return True
     except Exception as e:
 
@@ -376,8 +491,7 @@ class Schedule(Logger):
   def all_jobs_are_done( self, task ):
 
     try:
-      total = len(self.db().session().query(Job).filter( Job.taskId==task.id ).all())
-      if len(self.db().session().query(Job).filter( and_ ( Job.taskId==task.id, Job.status==Status.DONE ) ).all()) == total:
+      if self.count( task, Status.DONE ) == self.count( task ):
         return True
       else:
         return False
@@ -394,11 +508,7 @@ class Schedule(Logger):
   def all_jobs_ran( self, task ):
 
     try:
-      total = len(self.db().session().query(Job).filter( Job.taskId==task.id ).all())
-      total_done = len(self.db().session().query(Job).filter( and_ ( Job.taskId==task.id, Job.status==Status.DONE ) ).all())
-      total_failed = len(self.db().session().query(Job).filter( and_ ( Job.taskId==task.id, Job.status==Status.FAILED ) ).all())
-
-      if (total_done + total_failed) == total:
+      if self.count( task, [Status.DONE, Status.FAILED] ) == self.count( task ):
         return True
       else:
         return False
@@ -414,12 +524,9 @@ class Schedule(Logger):
   def check_not_allow_job_status_in_running_state( self, task ):
 
     try:
-      exist_registered_jobs = False
-      for job in task.getAllJobs():
-        if job.getStatus()==Status.REGISTERED:
-          job.setStatus(Status.ASSIGNED)
-          exist_registered_jobs=True
-      return exist_registered_jobs
+      if self.count( task, Status.REGISTERED ) == 0:
+        return False
+      return self.update_jobs( task, {Job.status:Status.ASSIGNED}, include=[Status.REGISTERED] ) > 0
     except Exception as e:
 
       MSG_ERROR( "Exception raise in state %s for this task %s :",task.getStatus(), task.taskName, e )
@@ -435,7 +542,7 @@ class Schedule(Logger):
     try:
       subject = ("[LPS Cluster] Notification for taskID %d")%(task.id)
       message = ("The task with name %s was assigned with DONE status.")%(task.taskName)
-      self.__postman.send(task.getUser().email, subject, message)
+      self.__postman.send(task.getUser().email, subject, message, kind='task_done')
       return True
     except Exception as e:
       MSG_ERROR(self, e)
@@ -452,7 +559,7 @@ class Schedule(Logger):
     try:
       subject = ("[LPS Cluster] Notification for taskID %d")%(task.id)
       message = ("Your task with name %s was set to BROKEN status.")%(task.taskName)
-      self.__postman.send(task.getUser().email, subject, message)
+      self.__postman.send(task.getUser().email, subject, message, kind='task_broken')
       return True
     except:
 
@@ -468,7 +575,7 @@ class Schedule(Logger):
     try:
       subject = ("[LPS Cluster] Notification for taskID %d")%(task.id)
       message = ("The task with name %s was assigned with FINALIZED status.")%(task.taskName)
-      self.__postman.send(task.getUser().email, subject, message)
+      self.__postman.send(task.getUser().email, subject, message, kind='task_finalized')
       return True
     except:
 
@@ -485,7 +592,7 @@ class Schedule(Logger):
     try:
       subject = ("[LPS Cluster] Notification for taskID %d")%(task.id)
       message = ("The task with name %s was assigned with KILLED status.")%(task.taskName)
-      self.__postman.send(task.getUser().email, subject, message)
+      self.__postman.send(task.getUser().email, subject, message, kind='task_killed')
       return True
     except:
 
@@ -8,11 +8,10 @@ from Gaugi import StatusCode
 from collections import deque
 from orchestra import Status
 from orchestra.Consumer import Consumer
+from orchestra.Supervisor import Supervisor
+from orchestra.Devices import DeviceDiscovery
 from orchestra import Postman
 
-# import tensorflow to retrieve the number of GPUs devices
-import tensorflow as tf;
-
 
 class SingleSlot( object ):
 
@@ -51,8 +50,13 @@ class SingleSlot( object ):
 
 
 class GPUSlot( SingleSlot ):
-  def __init__(self, name, device ):
+  def __init__(self, name, device, info=None ):
     SingleSlot.__init__( self, name, device )
+    self.__info = info
+
+  # The device description (memory and utilization) if found by the discovery
+  def info(self):
+    return self.__info
 
 
 
@@ -82,6 +86,10 @@ class Slots( Logger ):
     self.__db = db
     self.__postman = postman
     self.__node = node
+    # Detect the consumer process exits
+    self.__supervisor = Supervisor()
+    # Find the GPU devices (only for gpu slots)
+    self.__discovery = DeviceDiscovery() if gpu else None
 
 
   def postman (self):
@@ -113,11 +121,15 @@ class Slots( Logger ):
 
 
     # Check if we have GPUs in the current node
+    devices = []
     if self.__gpu and (self.__node.getMaxNumberOfSlots( gpu=True) > 0):
-      ngpus = len(tf.config.experimental.list_physical_devices('GPU'))
-      MSG_INFO( self, "Number of GPUs found in %s: %d", self.__node.getName(), ngpus)
-      if ngpus==0:
+      devices = self.__discovery.discover()
+      MSG_INFO( self, "Number of GPUs found in %s: %d", self.__node.getName(), len(devices))
+      if len(devices)==0:
         return StatusCode.FATAL
+      if len(devices) < self.__node.getMaxNumberOfSlots( gpu=True ):
+        MSG_WARNING( self, "The node %s has %d GPU slots but only %d devices were found.", self.__node.getName(),
+                     self.__node.getMaxNumberOfSlots( gpu=True ), len(devices) )
 
 
 
@@ -126,7 +138,8 @@ class Slots( Logger ):
 
     if self.__gpu:
       # The node start enable flag as False. You must enable this in the first interation
-      self.__available_slots = [ GPUSlot(self.__node.getName(),idx) for idx in range(self.__node.getMaxNumberOfSlots( gpu=True )) ]
+      self.__available_slots = [ GPUSlot(self.__node.getName(), devices[idx].index(), devices[idx]) if idx < len(devices) else
+                                 GPUSlot(self.__node.getName(), idx) for idx in range(self.__node.getMaxNumberOfSlots( gpu=True )) ]
     else:
       # The node start enable flag as False. You must enable this in the first interation
       self.__available_slots = [ CPUSlot(self.__node.getName()) for _ in range(self.__node.getMaxNumberOfSlots()) ]
@@ -164,60 +177,91 @@ class Slots( Logger ):
 
     self.update()
 
+    # Reap all consumers that exited since the last tick
+    self.__supervisor.poll()
 
-    for idx, consumer in enumerate(self.__slots):
+    # Iterate over a copy since finished consumers will be removed from the list
+    for idx, consumer in enumerate(list(self.__slots)):
 
 
       if consumer.job().getStatus() == Status.KILL:
         consumer.kill()
 
+      # The status is computed only once per tick
+      status = consumer.status()
 
-      if consumer.status() is Status.PENDING:
+      if status is Status.PENDING:
 
         if consumer.execute().isFailure():
 
           consumer.job().setStatus( Status.BROKEN )
-          consumer.finalize()
-          consumer.slot().unlock()
-          self.__slots.remove(consumer)
+          self.__remove( consumer )
 
         else: # change to running status
           consumer.job().setStatus( Status.RUNNING )
+          self.__supervisor.add( consumer )
 
-      elif consumer.status() is Status.FAILED:
+      elif status is Status.FAILED:
 
         consumer.job().setStatus( Status.FAILED )
-        consumer.finalize()
-        consumer.slot().unlock()
-        self.__slots.remove(consumer)
+        self.__remove( consumer )
 
-      elif consumer.status() is Status.KILL:
+      elif status is Status.KILL:
 
         consumer.job().setStatus( Status.KILLED )
-        consumer.finalize()
-        consumer.slot().unlock()
-        self.__slots.remove(consumer)
+        self.__remove( consumer )
 
-      elif consumer.status() is Status.RUNNING:
-        consumer.ping()
+      elif status is Status.DONE:
+        consumer.job().setStatus( Status.DONE )
+        self.__remove( consumer )
 
+    # The heartbeat of the running jobs and the commit are done by the pilot once per tick
+    return StatusCode.SUCCESS
 
-      elif consumer.status() is Status.DONE:
-        consumer.job().setStatus( Status.DONE )
-        consumer.finalize()
-        consumer.slot().unlock()
-        self.__slots.remove(consumer)
 
-      # update the current consumer
-      self.db().commit()
+  #
+  # The pidfd of all running consumers, so the pilot can wake up when one of them exit
+  #
+  def fds(self):
+    return self.__supervisor.fds()
 
-    return StatusCode.SUCCESS
+
+  #
+  # The id of all jobs allocated into these slots (used by the heartbeat)
+  #
+  def jobs(self):
+    return [ consumer.jobId() for consumer in self.__slots ]
 
 
   def finalize(self):
     return StatusCode.SUCCESS
 
 
+  #
+  # Stop and remove the consumers of these jobs without change the jobs, since they are not
+  # allocated to this node anymore (e.g. the claim was not committed). Return the number of
+  # removed consumers.
+  #
+  def release( self, ids ):
+    removed = 0
+    for consumer in list(self.__slots):
+      if consumer.jobId() in ids:
+        consumer.stop()
+        self.__remove( consumer )
+        removed += 1
+    return removed
+
+
+  #
+  # Release the slot and remove the consumer from the list
+  #
+  def __remove( self, consumer ):
+    self.__supervisor.remove( consumer )
+    consumer.finalize()
+    consumer.slot().unlock()
+    self.__slots.remove( consumer )
+
+
   def size(self):
     return self.__total
 
@@ -235,10 +279,19 @@ class Slots( Logger ):
 
 
   def getAvailableSlot(self):
-    for slot in self.__available_slots:
-      if slot.isAvailable():
-        return slot
-    return None
+    slots = [ slot for slot in self.__available_slots if slot.isAvailable() ]
+    if not slots:
+      return None
+    if not self.__gpu:
+      return slots[0]
+    # Place the job into the device with more free memory and less utilization
+    self.__discovery.update()
+    def rank( slot ):
+      info = slot.info()
+      if info is None:
+        return (0, 0)
+      return ( info.memoryFree() or 0, -(info.utilization() or 0) )
+    return max( slots, key=rank )
 
 
 
@@ -285,7 +338,6 @@ class Slots( Logger ):
       slot = self.getAvailableSlot()
       consumer = Consumer( job, slot, self.db() )
       consumer.job().setStatus( Status.PENDING )
-      job.ping()
       consumer.initialize()
       self.__slots.append( consumer )
       slot.lock()
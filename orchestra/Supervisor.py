@@ -0,0 +1,83 @@
+
+__all__ = ["Supervisor"]
+
+
+from Gaugi import Logger
+from Gaugi.messenger.macros import *
+import os, select
+
+
+#
+# Watch all consumer processes of one slot list. The exits are detected using one poll over
+# the process file descriptors (pidfd) of all consumers, so running jobs cost nothing per tick.
+# The pilot also blocks on these descriptors (fds), so one exit wakes up the next tick at once.
+# Without pidfd support (linux < 5.3 or python < 3.9) the consumers will poll themselves.
+#
+class Supervisor( Logger ):
+
+  #
+  # Constructor
+  #
+  def __init__(self):
+    Logger.__init__(self)
+    self.__consumers = {}
+    self.__poller = select.poll() if ( hasattr(os, 'pidfd_open') and hasattr(select, 'poll') ) else None
+
+
+  #
+  # Start to watch the process of this consumer
+  #
+  def add( self, consumer ):
+    pid = consumer.pid()
+    if self.__poller is None or pid is None:
+      return False
+    try:
+      fd = os.pidfd_open( pid )
+    except OSError as e:
+      MSG_WARNING( self, "Not possible to watch the process %d (%s). The consumer will poll itself.", pid, e )
+      return False
+    self.__poller.register( fd, select.POLLIN )
+    self.__consumers[fd] = consumer
+    consumer.supervise()
+    return True
+
+
+  #
+  # Stop to watch this consumer (e.g. killed before the process exit)
+  #
+  def remove( self, consumer ):
+    for fd, _consumer in list(self.__consumers.items()):
+      if _consumer is consumer:
+        self.__release( fd )
+
+
+  #
+  # Reap all consumers with processes that exited since the last call. Never blocks.
+  #
+  def poll( self ):
+    if not self.__consumers:
+      return []
+    consumers = []
+    for fd, _ in self.__poller.poll(0):
+      consumer = self.__release( fd )
+      consumer.reap()
+      consumers.append( consumer )
+    return consumers
+
+
+  def __release( self, fd ):
+    consumer = self.__consumers.pop( fd )
+    self.__poller.unregister( fd )
+    os.close( fd )
+    return consumer
+
+
+  #
+  # The pidfd of all watched processes. Each one will be ready (readable) when its process exit
+  #
+  def fds( self ):
+    return list( self.__consumers.keys() )
+
+
+  def __len__( self ):
+    return len(self.__consumers)
@@ -17,6 +17,10 @@ from . import mailing
 __all__.extend(mailing.__all__)
 from .mailing import *
 
+from . import Devices
+__all__.extend(Devices.__all__)
+from .Devices import *
+
 from . import Slots
 __all__.extend(Slots.__all__)
 from .Slots import *
@@ -25,6 +29,14 @@ from . import Consumer
 __all__.extend(Consumer.__all__)
 from .Consumer import *
 
+from . import Supervisor
+__all__.extend(Supervisor.__all__)
+from .Supervisor import *
+
+from . import Heartbeat
+__all__.extend(Heartbeat.__all__)
+from .Heartbeat import *
+
 from . import Schedule
 __all__.extend(Schedule.__all__)
 from .Schedule import *
@@ -3,12 +3,54 @@ __all__ = ["OrchestraDB"]
 
 from Gaugi import Logger, StatusCode
 from Gaugi.messenger.macros import *
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, inspect, text, Sequence
+from sqlalchemy.orm import sessionmaker, scoped_session, joinedload
+from sqlalchemy.engine import make_url
 from orchestra.db.models import *
+from orchestra.enums import Status, Signal
+from orchestra.db.UnitOfWork import UnitOfWork
 #from orchestra.constants import *
-from sqlalchemy import and_, or_
-import time
+from sqlalchemy import and_, or_, func, any_, bindparam, update
+from sqlalchemy.types import ARRAY, Integer
+import time, select, itertools, datetime, threading
+
+
+#
+# All changes that must wake up the pilots (job status, task and node signals) will be
+# published into this channel by database triggers (postgres only). The payload is
+# "<table>:<key>" where key is the task id for jobs and tasks and the name for nodes.
+#
+NOTIFY_CHANNEL = 'orchestra'
+
+NOTIFY_TRIGGERS = [
+  """
+  CREATE OR REPLACE FUNCTION orchestra_notify() RETURNS trigger AS $$
+  BEGIN
+    PERFORM pg_notify( '%s', TG_TABLE_NAME || ':' || coalesce( to_jsonb(NEW) ->> TG_ARGV[0], '' ) );
+    RETURN NULL;
+  END;
+  $$ LANGUAGE plpgsql
+  """ % NOTIFY_CHANNEL,
+  'DROP TRIGGER IF EXISTS orchestra_job_status ON job',
+  """
+  CREATE TRIGGER orchestra_job_status AFTER UPDATE OF status ON job FOR EACH ROW
+  WHEN ( OLD.status IS DISTINCT FROM NEW.status ) EXECUTE PROCEDURE orchestra_notify('taskId')
+  """,
+  'DROP TRIGGER IF EXISTS orchestra_task_signal ON task',
+  """
+  CREATE TRIGGER orchestra_task_signal AFTER UPDATE OF signal ON task FOR EACH ROW
+  WHEN ( OLD.signal IS DISTINCT FROM NEW.signal ) EXECUTE PROCEDURE orchestra_notify('id')
+  """,
+  'DROP TRIGGER IF EXISTS orchestra_task_insert ON task',
+  """
+  CREATE TRIGGER orchestra_task_insert AFTER INSERT ON task FOR EACH ROW EXECUTE PROCEDURE orchestra_notify('id')
+  """,
+  'DROP TRIGGER IF EXISTS orchestra_node_signal ON node',
+  """
+  CREATE TRIGGER orchestra_node_signal AFTER UPDATE OF signal ON node FOR EACH ROW
+  WHEN ( OLD.signal IS DISTINCT FROM NEW.signal ) EXECUTE PROCEDURE orchestra_notify('name')
+  """,
+]
 
 
 
@@ -17,15 +59,115 @@ import time
 
 class OrchestraDB(Logger):
 
-  def __init__( self, url):
+  #
+  # The pool options (pool_size, max_overflow, pool_recycle and statement_timeout in seconds) come
+  # from the orchestra config when not given. Connections are always checked (pre ping) before use.
+  #
+  def __init__( self, url, pool_size=None, max_overflow=None, pool_recycle=None, statement_timeout=None, replica=None ):
 
     Logger.__init__(self)
+    self.__url = url
+    # Read only queries (e.g. maestro list commands) use this database (postgres_replica or url)
+    self.__replica = replica
+    self.__reader = None
+    self.__pool = { 'pool_size'         : pool_size,
+                    'max_overflow'      : max_overflow,
+                    'pool_recycle'      : pool_recycle,
+                    'statement_timeout' : statement_timeout }
+    self.__engine = None
+    # One session for each thread
+    self.__session = None
+    # Each thread has its own unit of work
+    self.__local = threading.local()
+    # dedicated connection used to LISTEN for changes
+    self.__listener = None
+    # True after listen (until unlisten), even if the connection was lost
+    self.__listening = False
+
+
+
+  #
+  # The engine (and the session) will be created only when the database is used for the first time
+  #
+  def engine(self):
+    if self.__engine is None:
+      try:
+        self.__engine = create_engine(self.__url, **self.__engine_options(self.__url))
+        self.__session = scoped_session( sessionmaker(bind=self.__engine) )
+      except Exception as e:
+        MSG_FATAL( self, e )
+    return self.__engine
+
+
+
+  def __engine_options(self, url):
+    from orchestra.utils import getConfig
+    config = getConfig()
+    pool = { key : (value if value is not None else config[key]) for key, value in self.__pool.items() }
+    options = { 'pool_pre_ping' : True }
+    # sqlite uses its own pool (one connection per thread or in memory)
+    if make_url(url).get_backend_name() != 'sqlite':
+      options['pool_size'] = pool['pool_size']
+      options['max_overflow'] = pool['max_overflow']
+      if pool['pool_recycle'] > 0:
+        options['pool_recycle'] = pool['pool_recycle']
+    if make_url(url).get_backend_name() == 'postgresql' and pool['statement_timeout'] > 0:
+      options['connect_args'] = { 'options' : '-c statement_timeout=%d' % (pool['statement_timeout']*1000) }
+    return options
+
+
+
+  #
+  # The read only session of the current thread. Used by the commands that only show information,
+  # so they never take locks or write into the primary database. The session runs into one
+  # snapshot (repeatable read) and a new snapshot is started when snapshot is True. The caller
+  # must end the snapshot (commit) when done, so the connection is not left idle in transaction.
+  # The loaded objects are not expired by the commit.
+  #
+  def readonly(self, snapshot=True):
+    if self.__reader is None:
+      from orchestra.utils import getConfig
+      url = self.__replica if self.__replica else getConfig().get('postgres_replica')
+      url = url if url else self.__url
+      try:
+        engine = create_engine( url, **self.__engine_options(url) )
+        if engine.dialect.name == 'postgresql':
+          engine = engine.execution_options( isolation_level='REPEATABLE READ', postgresql_readonly=True )
+        self.__reader = scoped_session( sessionmaker(bind=engine, autoflush=False, expire_on_commit=False) )
+      except Exception as e:
+        MSG_FATAL( self, e )
+    session = self.__reader()
+    if snapshot:
+      session.rollback()
+    return session
+
+
+
+  #
+  # Expression with the database time minus these seconds (avoid the clock skew between nodes)
+  #
+  def ago( self, seconds, session=None ):
+    session = session if session else self.session()
+    if session.get_bind().dialect.name == 'postgresql':
+      return func.now() - datetime.timedelta(seconds=seconds)
+    # sqlite (utc)
+    return func.datetime('now', '-%d seconds' % int(seconds))
+
+
+
+  #
+  # Drop all connections after a database failure. The objects loaded by the session are kept
+  # (expired) and will be loaded again using a new connection.
+  #
+  def reconnect(self):
     try:
-      self.__engine = create_engine(url)
-      Session= sessionmaker(bind=self.__engine)
-      self.__session = Session()
+      self.session().rollback()
     except Exception as e:
-      MSG_FATAL( self, e )
+      MSG_WARNING( self, e )
+    self.engine().dispose()
+    if self.__listening:
+      self.__unlisten()
+      self.__listen()
 
 
 
@@ -90,6 +232,44 @@ class OrchestraDB(Logger):
       return None
 
 
+  #
+  # Insert all jobs of this task using one executemany per chunk instead of creating one ORM
+  # object per job. Jobs can be any iterable (e.g. a generator) of dicts with configFilePath,
+  # configId, execArgs and (optional) status and priority. Return the number of jobs created.
+  #
+  def createJobs( self, task, jobs, chunksize=1000 ):
+
+    try:
+      # The task must exist before its jobs
+      self.session().flush()
+      jobs = iter(jobs); total = 0
+      while True:
+        chunk = list( itertools.islice( jobs, chunksize ) )
+        if not chunk:
+          break
+        ids = self.generateIds( Job, len(chunk) )
+        rows = [ dict(
+                  id=ids[idx],
+                  configFilePath=job['configFilePath'],
+                  containerImage=task.containerImage,
+                  configId=job['configId'],
+                  execArgs=job.get('execArgs', "{}"),
+                  retry=0,
+                  status=job.get('status', Status.REGISTERED),
+                  priority=job.get('priority', 1000),
+                  userId = task.userId,
+                  queueName = task.getQueueName(),
+                  taskId = task.id,
+                ) for idx, job in enumerate(chunk) ]
+        self.session().execute( Job.__table__.insert(), rows )
+        total += len(rows)
+      return total
+    except Exception as e:
+      MSG_ERROR( self, e)
+      return None
+
+
+
   def getUser( self, username ):
     try:
       return self.session().query(Worker).filter(Worker.username==username).first()
@@ -125,6 +305,70 @@ class OrchestraDB(Logger):
 
 
 
+  #
+  # Get all tasks that can still change its state. Tasks in a final state (done, killed, broken,
+  # finalized, removed, ...) will only be returned when the user sent a signal to it
+  #
+  def getAllActiveTasks( self ):
+    try:
+      active = [Status.REGISTERED, Status.TESTING, Status.RUNNING, Status.KILL]
+      return self.session().query(Task).options( joinedload(Task.user) ).filter(
+          or_( Task.status.in_(active), Task.signal!=Signal.WAITING ) ).order_by(Task.id).all()
+    except Exception as e:
+      MSG_ERROR( self, e)
+      return []
+
+
+
+  #
+  # Create all tables and indexes that do not exist into the database. This is idempotent
+  # and must be used to migrate an old database to the current schema.
+  #
+  def migrate( self ):
+    try:
+      Base.metadata.create_all( self.engine() )
+      # create_all will skip tables that already exist, so their new columns and indexes must be created here
+      inspector = inspect( self.engine() )
+      preparer = self.engine().dialect.identifier_preparer
+      for table in Base.metadata.sorted_tables:
+        columns = [ column['name'] for column in inspector.get_columns(table.name) ]
+        for column in table.columns:
+          if column.name not in columns:
+            MSG_INFO( self, "Adding column %s into table %s", column.name, table.name )
+            with self.engine().begin() as conn:
+              conn.execute( text( "ALTER TABLE %s ADD COLUMN %s %s" % (preparer.format_table(table),
+                preparer.format_column(column), column.type.compile(dialect=self.engine().dialect)) ) )
+        for index in table.indexes:
+          MSG_INFO( self, "Creating index %s for table %s (if not exist)", index.name, table.name )
+          index.create( self.engine(), checkfirst=True )
+      if self.engine().dialect.name == 'postgresql':
+        # Old databases were filled using explicit ids, so all sequences must start after the last id
+        with self.engine().begin() as conn:
+          for table in Base.metadata.sorted_tables:
+            sequence = table.c.id.default if 'id' in table.c else None
+            if isinstance( sequence, Sequence ):
+              MSG_INFO( self, "Moving sequence %s after the last id of table %s", sequence.name, table.name )
+              conn.execute( text( ("SELECT setval('{seq}', GREATEST( (SELECT coalesce(max(id)+1, 1) FROM {table}), " +
+                "(SELECT CASE WHEN is_called THEN last_value+1 ELSE last_value END FROM {seq}) ), false)").format(
+                seq=sequence.name, table=table.name) ) )
+        MSG_INFO( self, "Creating all notification triggers for channel %s", NOTIFY_CHANNEL )
+        with self.engine().begin() as conn:
+          for command in NOTIFY_TRIGGERS:
+            conn.execute( text(command) )
+      # Fill the summary of all tasks created before the task_summary table
+      MSG_INFO( self, "Updating the summary of all tasks..." )
+      tasks = self.session().query(Task).outerjoin(TaskSummary).filter( TaskSummary.taskId==None ).all()
+      for idx in range( 0, len(tasks), 1000 ):
+        chunk = tasks[idx:idx+1000]
+        self.updateTaskSummaries( chunk, self.getJobStatusHistogram( [task.id for task in chunk] ) )
+        self.commit()
+      return True
+    except Exception as e:
+      MSG_ERROR( self, e )
+      return False
+
+
+
   def getAllJobs( self, task ):
     try:
       return job.getAllJobs()
@@ -133,17 +377,144 @@ class OrchestraDB(Logger):
 
 
 
+  #
+  # Count the number of jobs for each task and status using a single GROUP BY query.
+  # The answer is a dict like { taskId : { status : total } }. Errors are raised, since an empty
+  # answer would look like tasks without jobs (and all "all jobs are ..." checks would pass).
+  #
+  def getJobStatusHistogram( self, taskIds=None, session=None ):
+    session = session if session else self.session()
+    query = session.query( Job.taskId, Job.status, func.count(Job.id) )
+    if taskIds is not None:
+      query = query.filter( Job.taskId.in_(taskIds) )
+    histogram = {}
+    for taskId, status, total in query.group_by( Job.taskId, Job.status ).all():
+      histogram.setdefault( taskId, {} )[status] = total
+    return histogram
+
+
+
+  #
+  # Update the summary (jobs by status and the task status) of these tasks using the histogram
+  # from getJobStatusHistogram. Only summaries with changes are written (and get a new updated
+  # time). Not committed. Return the number of changed summaries.
+  #
+  def updateTaskSummaries( self, tasks, histogram ):
+    if not tasks:
+      return 0
+    try:
+      summaries = { summary.taskId : summary for summary in
+                    self.session().query(TaskSummary).filter( TaskSummary.taskId.in_([task.id for task in tasks]) ) }
+      changed = 0
+      for task in tasks:
+        summary = summaries.get( task.id )
+        if summary is None:
+          summary = TaskSummary( taskId=task.id )
+          self.session().add( summary )
+        if summary.update( histogram.get(task.id, {}), task.status ):
+          summary.updated = func.now()
+          changed += 1
+      return changed
+    except Exception as e:
+      MSG_ERROR(self, e)
+      return 0
+
+
+
+  #
+  # Get all tasks of this user (read only) with the number of jobs by status, like
+  # [ (task, {status : total}) ]. The counters come from the task summary (one query). Only
+  # tasks without summary (not seen by the schedule yet) are counted using one GROUP BY. If since
+  # is given, only the tasks with summary updated after this time are returned (and list_all is
+  # not used, so the caller can see the tasks that became done).
+  #
+  def getTaskSummaries( self, username, list_all=True, since=None ):
+    try:
+      session = self.readonly()
+      query = session.query( Task, TaskSummary ).join( Worker, Task.userId==Worker.id ).outerjoin( TaskSummary ) \
+                     .filter( Worker.username==username )
+      if since is not None:
+        query = query.filter( TaskSummary.updated > since )
+      elif not list_all:
+        query = query.filter( Task.status != Status.DONE )
+      # the objects loaded before (same session) must be updated
+      rows = query.order_by( Task.id ).populate_existing().all()
+      missing = [ task.id for task, summary in rows if summary is None ]
+      histogram = self.getJobStatusHistogram( missing, session ) if missing else {}
+      session.commit()
+      return [ (task, summary.histogram() if summary else histogram.get(task.id, {})) for task, summary in rows ]
+    except Exception as e:
+      MSG_ERROR(self, e)
+      return []
+
+
+
+  #
+  # The last time (database clock) that one summary of this user changed. None if there is no summary
+  #
+  def getTaskSummaryRevision( self, username ):
+    try:
+      session = self.readonly()
+      revision = session.query( func.max(TaskSummary.updated) ).join( Task, TaskSummary.taskId==Task.id ) \
+                        .join( Worker, Task.userId==Worker.id ).filter( Worker.username==username ).scalar()
+      session.commit()
+      return revision
+    except Exception as e:
+      MSG_ERROR(self, e)
+      return None
+
+
+
+  #
+  # The session of the current thread
+  #
   def session(self):
-    return self.__session
+    if self.__session is None:
+      self.engine()
+    return self.__session()
 
 
 
+  #
+  # Inside of a unit of work, only flush. The changes will be committed at the end of the block
+  #
   def commit(self):
-    self.session().commit()
+    uow = getattr( self.__local, 'uow', None )
+    if uow is not None and uow.active():
+      self.session().flush()
+    else:
+      self.session().commit()
 
 
+  #
+  # Inside of a unit of work, all changes recorded so far are applied again after the rollback
+  #
+  def rollback(self):
+    uow = getattr( self.__local, 'uow', None )
+    if uow is not None and uow.active():
+      uow.rollback()
+    else:
+      self.session().rollback()
+
+
+  #
+  # Collect all changes made inside of the with block into one transaction, committed (and
+  # retried in case of serialization failure) at the end of the block
+  #
+  def unit_of_work(self):
+    uow = getattr( self.__local, 'uow', None )
+    if uow is None:
+      uow = UnitOfWork( self )
+      self.__local.uow = uow
+    return uow
+
+
+  #
+  # Close the session of the current thread
+  #
   def close(self):
-    self.session().close()
+    if self.__session is not None:
+      self.__session.remove()
 
 
   def initialize( self ):
@@ -157,9 +528,85 @@ class OrchestraDB(Logger):
   def finalize( self ):
     self.commit()
     self.close()
+    self.unlisten()
     return StatusCode.SUCCESS
 
 
+
+  #
+  # Start to listen the notification channel using a dedicated connection (postgres only). If
+  # the connection is lost (or not possible now), wait will try to listen again.
+  #
+  def listen( self ):
+    if self.engine().dialect.name != 'postgresql':
+      MSG_WARNING( self, "Notifications are only available for postgres. Waiting will fallback to the timeout." )
+      return False
+    self.__listening = True
+    return self.__listen()
+
+
+
+  def unlisten( self ):
+    self.__listening = False
+    self.__unlisten()
+
+
+
+  def __listen( self ):
+    try:
+      self.__listener = self.engine().raw_connection()
+      self.__listener.connection.autocommit = True
+      cursor = self.__listener.cursor()
+      cursor.execute( "LISTEN %s" % NOTIFY_CHANNEL )
+      cursor.close()
+      return True
+    except Exception as e:
+      MSG_ERROR( self, e )
+      self.__listener = None
+      return False
+
+
+
+  def __unlisten( self ):
+    if self.__listener is not None:
+      try:
+        self.__listener.close()
+      except Exception as e:
+        MSG_WARNING( self, e )
+      self.__listener = None
+
+
+
+  #
+  # Block until one notification arrives, one of these file descriptors (e.g. the pidfd of the
+  # running jobs) is ready or the timeout (in seconds) expires. Return all payloads received
+  # (empty list in case of timeout) plus "process:<fd>" for each ready file descriptor. Without
+  # listener, only the file descriptors are watched.
+  #
+  def wait( self, timeout, fds=[] ):
+    if self.__listening and self.__listener is None and not self.__listen():
+      MSG_WARNING( self, "Not possible to listen the database. Polling until the next try in %1.1f seconds.", timeout )
+    if self.__listener is None:
+      ready = select.select( fds, [], [], timeout )[0] if fds else time.sleep( timeout )
+      return [ 'process:%d' % fd for fd in (ready or []) ]
+    try:
+      conn = self.__listener.connection
+      ready = []
+      if not conn.notifies:
+        ready = select.select( [conn] + list(fds), [], [], timeout )[0]
+        if conn in ready:
+          conn.poll()
+      payloads = [ notify.payload for notify in conn.notifies ]
+      del conn.notifies[:]
+      return payloads + [ 'process:%d' % fd for fd in ready if fd is not conn ]
+    except Exception as e:
+      # Lost the connection. Try to listen again now (or in the next call)
+      MSG_ERROR( self, e )
+      self.__unlisten()
+      self.__listen()
+      return []
+
+
   def retryTask( self, taskname ):
     try:
       task = self.getTask( args.taskname  )
@@ -214,6 +661,23 @@ class OrchestraDB(Logger):
 
 
 
+  #
+  # All nodes (read only) with a flag telling if the node sent a heartbeat in the last timeout
+  # seconds. The check uses the database clock. The answer is a list of (node, alive).
+  #
+  def getAllNodesStatus(self, timeout):
+    try:
+      session = self.readonly()
+      alive = and_( Node.timer != None, Node.timer > self.ago(timeout, session) )
+      nodes = [ (node, bool(status)) for node, status in session.query( Node, alive ).order_by(Node.name).populate_existing().all() ]
+      session.commit()
+      return nodes
+    except Exception as e:
+      MSG_ERROR(self, e)
+      return []
+
+
+
   def getNode( self, nodeName ):
     try:
       return self.session().query(Node).filter(Node.name==nodeName).first()
@@ -223,11 +687,91 @@ class OrchestraDB(Logger):
 
 
 
+  #
+  # Set the heartbeat of all these jobs using one UPDATE. The time comes from the database
+  # (now()) to avoid clock skew between nodes. Only running jobs still allocated to this node
+  # are changed, so a job requeued and claimed by other node is not kept alive by the old one.
+  # Not committed. Return the number of jobs.
+  #
+  def pingJobs( self, ids, nodeName ):
+    if not ids:
+      return 0
+    try:
+      if self.engine().dialect.name == 'postgresql':
+        # one array parameter (id = ANY(:ids)) instead of one parameter per job
+        criteria = Job.id == any_( bindparam( 'ids', list(ids), type_=ARRAY(Integer) ) )
+      else:
+        criteria = Job.id.in_( list(ids) )
+      return self.session().query(Job).filter( criteria, Job.nodeName==nodeName, Job.status==Status.RUNNING ) \
+                           .update( {Job.timer : func.now()}, synchronize_session=False )
+    except Exception as e:
+      MSG_ERROR(self, e)
+      return 0
+
+
+
+  #
+  # Set the heartbeat of this node using the database time. Not committed.
+  #
+  def pingNode( self, nodeName ):
+    try:
+      return self.session().query(Node).filter( Node.name==nodeName ).update( {Node.timer : func.now()}, synchronize_session=False )
+    except Exception as e:
+      MSG_ERROR(self, e)
+      return 0
+
+
+
+  #
+  # Move all running jobs without heartbeat for more than timeout seconds back to the queue
+  # (assigned) using one UPDATE. The staleness is checked by the database clock. If queues is
+  # given, only jobs of these queues (or of all other queues if exclude) are checked. Not
+  # committed. Return the id of all requeued jobs.
+  #
+  def requeueStaleJobs( self, timeout, queues=None, exclude=False ):
+    try:
+      criteria = [ Job.status==Status.RUNNING ]
+      if queues is not None:
+        criteria.append( Job.queueName.notin_(queues) if exclude else Job.queueName.in_(queues) )
+
+      criteria.append( or_( Job.timer==None, Job.timer < self.ago(timeout) ) )
+      if self.engine().dialect.name == 'postgresql':
+        stmt = update(Job).where( and_(*criteria) ).values( status=Status.ASSIGNED, nodeName=None ).returning( Job.id )
+        stmt = stmt.execution_options( synchronize_session=False )
+        return [ id for (id,) in self.session().execute( stmt ) ]
+      else:
+        # sqlite: there is no returning
+        ids = [ id for (id,) in self.session().query(Job.id).filter( and_(*criteria) ).all() ]
+        if ids:
+          self.session().query(Job).filter( Job.id.in_(ids) ).update( {Job.status:Status.ASSIGNED, Job.nodeName:None},
+                                                                      synchronize_session=False )
+        return ids
+    except Exception as e:
+      MSG_ERROR(self, e)
+      return []
+
+
+
   def generateId( self, model  ):
-    if self.session().query(model).all():
-      return self.session().query(model).order_by(model.id.desc()).first().id + 1
+    return self.generateIds( model, 1 )[0]
+
+
+
+  #
+  # Reserve a block of n ids for this model in one round trip. For postgres, the ids come from the
+  # table sequence and are safe against concurrent creators (but not always contiguous).
+  #
+  def generateIds( self, model, n ):
+    if n <= 0:
+      return []
+    sequence = model.__table__.c.id.default
+    if self.engine().dialect.name == 'postgresql' and isinstance( sequence, Sequence ):
+      return list( self.session().execute( text("SELECT nextval(:name) FROM generate_series(1, :n)"),
+                                           {'name':sequence.name, 'n':n} ).scalars() )
     else:
-      return 0
+      last = self.session().query( func.max(model.id) ).scalar()
+      first = 0 if last is None else last + 1
+      return list( range( first, first + n ) )
 
 
 
@@ -262,6 +806,55 @@ class OrchestraDB(Logger):
 
 
 
+  #
+  # Insert all paths as files of this dataset using one executemany. Return the number of files created.
+  #
+  def createFiles( self, dataset, paths ):
+    try:
+      ids = self.generateIds( File, len(paths) )
+      rows = [ dict( id=ids[idx], path=path, datasetId=dataset.id ) for idx, path in enumerate(paths) ]
+      if rows:
+        self.session().execute( File.__table__.insert(), rows )
+      return len(rows)
+    except Exception as e:
+      MSG_ERROR( self, e)
+      return None
+
+
+
+  #
+  # Delete all rows of this model matching the criteria using one statement per chunk. Each chunk
+  # is committed, so the locks are released often and the schedule is never blocked for long.
+  # Return the number of deleted rows.
+  #
+  def deleteAll( self, model, criteria, chunksize=10000 ):
+    total = 0
+    while True:
+      ids = self.session().query(model.id).filter( criteria ).limit(chunksize).subquery()
+      deleted = self.session().query(model).filter( model.id.in_( ids.select() ) ).delete( synchronize_session=False )
+      self.commit()
+      total += deleted
+      if deleted < chunksize:
+        return total
+
+
+
+  #
+  # Stream all file paths of this dataset (ordered by id) without load the File objects
+  #
+  def getAllFilePaths( self, dataset, chunksize=1000 ):
+    query = self.session().query(File.path).filter( File.datasetId==dataset.id ).order_by(File.id)
+    for (path,) in query.yield_per(chunksize):
+      yield path
+
+
+
+  def countFiles( self, dataset ):
+    return self.session().query( func.count(File.id) ).filter( File.datasetId==dataset.id ).scalar()
+
+
+
+
   def createUser( self, username, email ):
 
     try:
@@ -0,0 +1,223 @@
+__all__ = ["UnitOfWork"]
+
+from Gaugi import Logger
+from Gaugi.messenger.macros import *
+from sqlalchemy import event, inspect, and_, insert, update, delete
+from sqlalchemy.sql import ClauseElement
+import time, threading
+
+
+# Postgres errors (serialization failure and deadlock) solved by running the transaction again
+RETRY_PGCODES = ('40001', '40P01')
+
+
+#
+# The value before the change was not loaded from the database
+#
+class NotLoaded(object):
+  pass
+
+
+#
+# Collect all changes made inside of one block (e.g. one pilot tick) into a single transaction.
+# The commits requested inside of the block only flush, and the real commit happens at the end.
+# All changes are recorded in a journal:
+#
+#   insert/update/delete : attribute changes of the ORM objects (recorded by each flush)
+#   statement            : bulk updates and deletes executed using the session
+#
+# If the transaction fails by a serialization failure or deadlock, the journal is replayed into a
+# new transaction and committed again. Attribute updates are replayed only if the row still has
+# the value read before the change (compare and set), so a job claimed by other pilot in the
+# meantime will not be overwritten. These rows are listed by dropped(), so the caller can undo
+# what was done outside of the database (e.g. stop the consumer of the job). If the commit is
+# not possible, the error is raised.
+#
+# usage:
+#
+#   with db.unit_of_work():
+#     ...
+#
+class UnitOfWork( Logger ):
+
+  #
+  # Constructor
+  #
+  def __init__(self, db, retries=3, retry_interval=0.1):
+    Logger.__init__(self)
+    self.__db = db
+    self.__retries = retries
+    self.__retry_interval = retry_interval
+    self.__journal = []
+    self.__depth = 0
+    self.__session = None
+    self.__replaying = False
+    # (table name, identity) of the rows changed in the meantime and skipped by the replay
+    self.__dropped = []
+    # True if the database answered with one of the RETRY_PGCODES in this transaction
+    self.__conflict = False
+    # Each thread has its own session and unit of work
+    self.__thread = threading.get_ident()
+    event.listen( db.engine(), 'handle_error', self.__handle_error )
+
+
+  def active(self):
+    return self.__depth > 0
+
+
+  def journal(self):
+    return self.__journal
+
+
+  #
+  # The identity of all rows (of this table, if given) skipped by the replay since the block started
+  #
+  def dropped(self, table=None):
+    return [ identity for name, identity in self.__dropped if table is None or name == table ]
+
+
+  def __enter__(self):
+    if self.__depth == 0:
+      self.__journal = []
+      self.__dropped = []
+      self.__conflict = False
+      self.__session = self.__db.session()
+      event.listen( self.__session, 'before_flush', self.__before_flush )
+      event.listen( self.__session, 'after_flush', self.__after_flush )
+      event.listen( self.__session, 'do_orm_execute', self.__do_orm_execute )
+    self.__depth += 1
+    return self
+
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.__depth -= 1
+    if self.__depth > 0:
+      return False
+    try:
+      if exc_type is None:
+        self.commit()
+      else:
+        self.__session.rollback()
+    finally:
+      event.remove( self.__session, 'before_flush', self.__before_flush )
+      event.remove( self.__session, 'after_flush', self.__after_flush )
+      event.remove( self.__session, 'do_orm_execute', self.__do_orm_execute )
+      self.__session = None
+      self.__journal = []
+    return False
+
+
+  #
+  # Commit the transaction. In case of serialization failure (or deadlock), replay the journal
+  # and try again. Any other error (or the last conflict) is raised after the rollback.
+  #
+  def commit(self):
+    for attempt in range( self.__retries + 1 ):
+      try:
+        if attempt > 0:
+          self.replay()
+        self.__session.commit()
+        return True
+      except Exception as e:
+        self.__session.rollback()
+        if not self.__conflict or attempt == self.__retries:
+          MSG_ERROR( self, "Not possible to commit the transaction with %d changes: %s", len(self.__journal), e )
+          raise
+        wait = self.__retry_interval * (2**attempt)
+        MSG_WARNING( self, "Transaction conflict. Replaying %d changes in %1.2f seconds...", len(self.__journal), wait )
+        time.sleep( wait )
+        self.__conflict = False
+
+
+  #
+  # Rollback the current transaction and apply all changes recorded so far into a new one
+  #
+  def rollback(self):
+    self.__session.rollback()
+    self.replay()
+
+
+  #
+  # Apply all recorded changes into the current transaction. After one update is skipped, all
+  # later changes of the same row are skipped too.
+  #
+  def replay(self):
+    self.__replaying = True
+    try:
+      for entry in self.__journal:
+        kind = entry[0]
+        if kind in ('update', 'delete') and (entry[1].name, entry[2]) in self.__dropped:
+          continue
+        if kind == 'statement':
+          self.__session.execute( entry[1], entry[2], execution_options=entry[3] )
+        elif kind == 'insert':
+          self.__session.execute( insert(entry[1]).values( **entry[2] ) )
+        elif kind == 'delete':
+          self.__session.execute( delete(entry[1]).where( self.__identity(entry[1], entry[2]) ) )
+        elif kind == 'update':
+          table, identity, changes = entry[1:]
+          criteria = [ self.__identity(table, identity) ]
+          for column, (before, after) in changes.items():
+            if not isinstance(before, ClauseElement) and before is not NotLoaded:
+              criteria.append( table.c[column] == before )
+          answer = self.__session.execute( update(table).where( and_(*criteria) ).values(
+                                           { column : after for column, (_, after) in changes.items() } ) )
+          if answer.rowcount == 0:
+            MSG_WARNING( self, "The row %s of %s changed in the meantime. Skipping.", identity, table.name )
+            self.__dropped.append( (table.name, identity) )
+    finally:
+      self.__replaying = False
+
+
+  def __identity( self, table, identity ):
+    return and_( *[ column == value for column, value in zip(table.primary_key.columns, identity) ] )
+
+
+  #
+  # Record the updates and deletes before the flush, so they are kept even if the flush fails
+  #
+  def __before_flush( self, session, flush_context, instances ):
+    if self.__replaying:
+      return
+    for obj in session.dirty:
+      state = inspect(obj)
+      changes = {}
+      for prop in state.mapper.column_attrs:
+        history = state.attrs[prop.key].history
+        if history.added:
+          changes[prop.columns[0].name] = ( history.deleted[0] if history.deleted else NotLoaded, history.added[0] )
+      if changes:
+        self.__journal.append( ('update', state.mapper.local_table, state.identity, changes) )
+    for obj in session.deleted:
+      state = inspect(obj)
+      self.__journal.append( ('delete', state.mapper.local_table, state.identity) )
+
+
+  #
+  # Record the inserts after the flush (when the primary keys are known)
+  #
+  def __after_flush( self, session, flush_context ):
+    if self.__replaying:
+      return
+    for obj in session.new:
+      state = inspect(obj)
+      values = { prop.columns[0].name : state.attrs[prop.key].value for prop in state.mapper.column_attrs }
+      self.__journal.append( ('insert', state.mapper.local_table, values) )
+
+
+  #
+  # Record all bulk updates and deletes
+  #
+  def __do_orm_execute( self, orm_execute_state ):
+    if not self.__replaying and (orm_execute_state.is_update or orm_execute_state.is_delete):
+      self.__journal.append( ('statement', orm_execute_state.statement, orm_execute_state.parameters,
+                              orm_execute_state.local_execution_options) )
+
+
+  def __handle_error( self, context ):
+    if threading.get_ident() != self.__thread:
+      return
+    pgcode = getattr( context.original_exception, 'pgcode', None )
+    if pgcode in RETRY_PGCODES:
+      self.__conflict = True
+
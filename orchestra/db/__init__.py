@@ -4,6 +4,10 @@ from . import models
 __all__.extend( models.__all__ )
 from .models import *
 
+from . import UnitOfWork
+__all__.extend( UnitOfWork.__all__ )
+from .UnitOfWork import *
+
 from . import OrchestraDB
 __all__.extend( OrchestraDB.__all__ )
 from .OrchestraDB import *
@@ -1,6 +1,6 @@
 __all__ = ["Dataset","File"]
 
-from sqlalchemy import Column, Integer, String, Date, Float, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Date, Float, Boolean, ForeignKey, Index, Sequence
 from sqlalchemy.orm import relationship
 from orchestra.db.models import Base
 
@@ -11,11 +11,15 @@ class Dataset (Base):
   __tablename__ = 'dataset'
 
   # Local
-  id = Column(Integer, primary_key = True)
+  id = Column(Integer, Sequence('dataset_id_seq'), primary_key = True)
   username = Column(String)
   dataset = Column(String)
   files = relationship("File", order_by="File.id", back_populates="dataset")
 
+  __table_args__ = (
+    Index( 'ix_dataset_username_dataset', 'username', 'dataset' ),
+  )
+
 
   def getDatasetName(self):
     return self.datasetName
@@ -40,13 +44,17 @@ class File(Base):
   __tablename__ = 'file'
 
   # Local
-  id = Column(Integer, primary_key = True)
+  id = Column(Integer, Sequence('file_id_seq'), primary_key = True)
   path = Column(String)
 
   # Foreign
   dataset = relationship("Dataset", back_populates='files')
   datasetId = Column(Integer, ForeignKey('dataset.id'))
 
+  __table_args__ = (
+    Index( 'ix_file_datasetid', 'datasetId' ),
+  )
+
 
   def getPath(self):
     return self.path
@@ -1,7 +1,7 @@
 
 __all__ = ["Job"]
 
-from sqlalchemy import Column, Integer, String, Date, Float, Boolean, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, Date, Float, Boolean, ForeignKey, DateTime, Index, Sequence
 from sqlalchemy.orm import relationship
 from orchestra.db.models import Base
 import datetime
@@ -13,7 +13,7 @@ class Job (Base):
     __tablename__ = 'job'
 
     # Local
-    id = Column(Integer, primary_key = True)
+    id = Column(Integer, Sequence('job_id_seq'), primary_key = True)
 
     containerImage = Column(String)
 
@@ -38,10 +38,22 @@ class Job (Base):
     taskId = Column(Integer, ForeignKey('task.id'))
     userId = Column(Integer)
 
+    # The node that claimed this job from the queue
+    nodeName = Column(String)
+
 
     timer = Column(DateTime)
 
 
+    __table_args__ = (
+      # Used by the pilot to retrieve the next jobs to be executed for each queue. Must follow
+      # the same order used to claim the jobs (priority desc, id) to avoid a sort
+      Index( 'ix_job_status_queuename_priority_id', status, queueName, priority.desc(), id ),
+      # Used by the schedule triggers to count/change all jobs of a task
+      Index( 'ix_job_taskid_status', 'taskId', 'status' ),
+    )
+
+
     def __repr__ (self):
         return "<Job (configFilePath='{}', status='{}, taskId = {}, configId = {}', Priority = {})>".format(
             self.configFilePath, self.status, self.taskId, self.configId, self.priority
@@ -80,6 +92,14 @@ class Job (Base):
       return self.queueName
 
 
+    def getNodeName(self):
+      return self.nodeName
+
+
+    def setNodeName(self, name):
+      self.nodeName = name
+
+
     def getTaskName(self):
       return self.getTask().getTaskName()
 
@@ -88,10 +108,6 @@ class Job (Base):
       return self.getTask().getUser().getUserName()
 
 
-    def ping(self):
-      self.timer = datetime.datetime.now()
-
-
     def isAlive(self):
       if self.timer is None:
         return False
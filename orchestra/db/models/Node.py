@@ -45,10 +45,6 @@ class Node (Base):
     return self.enabledGPUSlots if gpu else self.enabledCPUSlots
 
 
-  def ping(self):
-    self.timer = datetime.datetime.now()
-
-
   def isAlive(self):
     if self.timer is None:
       return False
@@ -1,7 +1,7 @@
 __all__=['Task']
 
 
-from sqlalchemy import Column, Integer, String, Date, Float, Boolean, ForeignKey, JSON, DateTime
+from sqlalchemy import Column, Integer, String, Date, Float, Boolean, ForeignKey, JSON, DateTime, Index, Sequence
 from sqlalchemy.orm import relationship
 from orchestra.db.models import Base, Job
 import datetime
@@ -14,7 +14,7 @@ class Task (Base):
     __tablename__ = 'task'
   
     # Local
-    id = Column(Integer, primary_key = True)
+    id = Column(Integer, Sequence('task_id_seq'), primary_key = True)
     taskName = Column(String, unique=True)
   
     inputFilePath = Column(String)
@@ -37,10 +37,18 @@ class Task (Base):
     jobs = relationship("Job", order_by="Job.id", back_populates="task")
     userId = Column(Integer, ForeignKey('worker.id'))
     user = relationship("Worker", back_populates="tasks")
+    # Number of jobs in each status (maintained by the schedule)
+    summary = relationship("TaskSummary", uselist=False, back_populates="task")
   
   
     # Signal column to be user to retry, delete or kill functions
     signal = Column( String, default='waiting' )
+
+
+    __table_args__ = (
+      Index( 'ix_task_status', 'status' ),
+      Index( 'ix_task_userid', 'userId' ),
+    )
   
   
   
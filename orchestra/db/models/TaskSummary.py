@@ -0,0 +1,76 @@
+
+__all__=['TaskSummary']
+
+
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Index
+from sqlalchemy.orm import relationship
+from orchestra.db.models import Base
+from orchestra.enums import Status
+
+
+#
+#   Number of jobs in each status for each task. Kept up to date by the schedule, so the
+#   task list never needs to count the jobs. The updated column tells when the counters (or
+#   the task status) changed for the last time.
+#
+class TaskSummary (Base):
+
+    __tablename__ = 'task_summary'
+
+    # All job status with one counter column (the column name is the status value)
+    status_list = [ Status.REGISTERED, Status.ASSIGNED, Status.PENDING, Status.TESTING, Status.RUNNING,
+                    Status.DONE, Status.FAILED, Status.KILL, Status.KILLED, Status.BROKEN ]
+
+    taskId = Column(Integer, ForeignKey('task.id', ondelete='CASCADE'), primary_key = True)
+    task = relationship("Task", back_populates="summary")
+
+    # The task status when the counters were computed
+    status = Column(String)
+
+    registered = Column(Integer, default=0)
+    assigned   = Column(Integer, default=0)
+    pending    = Column(Integer, default=0)
+    testing    = Column(Integer, default=0)
+    running    = Column(Integer, default=0)
+    done       = Column(Integer, default=0)
+    failed     = Column(Integer, default=0)
+    kill       = Column(Integer, default=0)
+    killed     = Column(Integer, default=0)
+    broken     = Column(Integer, default=0)
+    total      = Column(Integer, default=0)
+
+    updated = Column(DateTime)
+
+
+    __table_args__ = (
+      # Used to find the tasks changed since the last refresh
+      Index( 'ix_task_summary_updated', 'updated' ),
+    )
+
+
+    def count(self, status):
+      return getattr(self, status) or 0
+
+
+    #
+    # Get all counters as a dict like { status : total }
+    #
+    def histogram(self):
+      return { status : self.count(status) for status in self.status_list }
+
+
+    #
+    # Set the counters and the task status. Return True if anything changed
+    #
+    def update(self, histogram, status):
+      changed = self.status != status
+      self.status = status
+      for s in self.status_list:
+        if self.count(s) != histogram.get(s, 0):
+          setattr(self, s, histogram.get(s, 0))
+          changed = True
+      total = sum( histogram.values() )
+      if self.total != total:
+        self.total = total
+        changed = True
+      return changed
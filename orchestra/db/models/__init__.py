@@ -23,6 +23,10 @@ from . import Dataset
 __all__.extend( Dataset.__all__ )
 from .Dataset import *
 
+from . import TaskSummary
+__all__.extend( TaskSummary.__all__ )
+from .TaskSummary import *
+
 
 
 
@@ -9,14 +9,13 @@ from Gaugi import StatusCode, Color, expandFolders
 from orchestra.db import Task,Dataset,File,Job
 from orchestra import Status, Signal, getStatus
 from sqlalchemy import and_, or_
-from prettytable import PrettyTable
 
 # common imports
 import glob
-import numpy as np
 import argparse
 import sys,os
 import hashlib
+import time
 
 from orchestra.utils import getConfig
 config = getConfig()
@@ -37,6 +36,10 @@ class DatasetParser( Logger ):
                                   help = "The dataset name used to registry into the database. (e.g: user.jodafons...)")
       registry_parser.add_argument('-p','--path', action='store', dest='path', required=True,
                                   help = "The path to the dataset")
+      registry_parser.add_argument('-b','--batch', action='store', dest='batch', required=False, type=int, default=1000,
+                                  help = "The number of files inserted (and committed) for each transaction.")
+      registry_parser.add_argument('--resume', action='store_true', dest='resume', required=False,
+                                  help = "Continue an interrupted registry. Files already registered will be skipped.")
 
       # Delete dataset using the dataset CLI
       unregistry_parser = argparse.ArgumentParser(description = 'Dataset unregistry command lines.', add_help = False)
@@ -65,7 +68,7 @@ class DatasetParser( Logger ):
     # Dataset CLI
     if args.mode == 'castor':
       if args.option == 'registry':
-        status, answer = self.registry(args.datasetname, args.path)
+        status, answer = self.registry(args.datasetname, args.path, args.batch, args.resume)
 
         if status.isFailure():
           MSG_FATAL(self, answer)
@@ -103,6 +106,7 @@ class DatasetParser( Logger ):
     if not username in [user.getUserName() for user in self.__db.getAllUsers()]:
       return (StatusCode.FATAL, 'The username does not exist into the database. Please, report this to the db manager...')
 
+    from prettytable import PrettyTable
     t = PrettyTable([ Color.CGREEN2 + 'Username' + Color.CEND,
                       Color.CGREEN2 + 'Dataset'  + Color.CEND,
                       Color.CGREEN2 + 'Files' + Color.CEND])
@@ -135,12 +139,14 @@ class DatasetParser( Logger ):
     ds = self.__db.getDataset( username, datasetname )
 
 
-    for file in ds.getAllFiles():
-      try:
-        self.__db.session().query(File).filter( File.id==file.id ).delete()
-      except Exception as e:
-        MSG_ERROR(self, e)
-        return (StatusCode.FATAL, "It's not possible to remove the file. %s"%e )
+    try:
+      # Delete all files in chunks
+      total = self.__db.deleteAll( File, File.datasetId==ds.id )
+      MSG_INFO( self, "Removed %d files from %s", total, datasetname )
+    except Exception as e:
+      MSG_ERROR(self, e)
+      self.__db.session().rollback()
+      return (StatusCode.FATAL, "It's not possible to remove the files. %s"%e )
 
     try:
       # Delete the dataset
@@ -156,9 +162,10 @@ class DatasetParser( Logger ):
 
 
   #
-  # registry a dataset
+  # registry a dataset. The directory tree is streamed and the files are inserted in batches (one
+  # transaction per batch), so an interrupted registry can be resumed.
   #
-  def registry( self , datasetname, path ):
+  def registry( self , datasetname, path, batch=1000, resume=False ):
 
     # check task policy
     if datasetname.split('.')[0] != 'user':
@@ -169,31 +176,65 @@ class DatasetParser( Logger ):
     if not username in [ user.getUserName() for user in self.__db.getAllUsers()]:
       return (StatusCode.FATAL, 'The username does not exist into the database. Please, report this to the db manager...')
 
-    if self.__db.getDataset( username, datasetname ):
-      return (StatusCode.FATAL, "The dataset exist into the database")
+    ds = self.__db.getDataset( username, datasetname )
+    if ds and not resume:
+      return (StatusCode.FATAL, "The dataset exist into the database. Use --resume to continue an interrupted registry.")
+
+    if not os.path.exists(path):
+      return (StatusCode.FATAL, "The path (%s) does not exist."%path )
 
     # Let's registry and upload into the database
     try:
-      # Create the new dataset
-      ds  = Dataset( id=self.__db.generateId(Dataset),username=username, dataset=datasetname )
-
-      # If dir doesn't exist, creates it
-      if not os.path.exists(path):
-        return (StatusCode.FATAL, "The path (%s) does not exist."%path )
-
-      # Loop over files
-      desired_id = self.__db.generateId(File)+1
-      for idx, subpath in enumerate(expandFolders(path)):
-        MSG_INFO( self, "Registry %s into %s", subpath,datasetname)
-        file= File(path=subpath,id=desired_id+idx)
-        ds.addFile(file)
-
-      self.__db.session().add(ds)
-      self.__db.commit()
+      if ds is None:
+        # Create the new dataset
+        ds  = Dataset( id=self.__db.generateId(Dataset),username=username, dataset=datasetname )
+        self.__db.createDataset(ds)
+        self.__db.commit()
+        registered = set()
+      else:
+        registered = set( self.__db.getAllFilePaths(ds) )
+        MSG_INFO( self, "Resuming the registry of %s with %d files already registered.", datasetname, len(registered) )
+
+      start = time.time(); total = 0; paths = []
+
+      def flush( paths, total ):
+        if self.__db.createFiles( ds, paths ) is None:
+          raise RuntimeError("Not possible to insert the files.")
+        self.__db.commit()
+        total += len(paths)
+        MSG_INFO( self, "Registered %d files into %s (%1.1f files/s)", total, datasetname, total/max(time.time()-start, 1e-6) )
+        return total
+
+      for subpath in self.__walk(path):
+        if subpath in registered:
+          continue
+        paths.append( subpath )
+        if len(paths) == batch:
+          total = flush( paths, total ); paths = []
+
+      if paths:
+        total = flush( paths, total )
+
     except Exception as e:
       MSG_ERROR(self,e)
-      return (StatusCode.FATAL, "Impossible to registry the dataset(%s)."%datasetname)
+      self.__db.session().rollback()
+      return (StatusCode.FATAL, "Impossible to registry the dataset(%s). Use --resume to continue."%datasetname)
 
     return (StatusCode.SUCCESS, "Successfully uploaded." )
 
 
+
+  #
+  # Walk over all files (sorted by name) below this path without build the full list
+  #
+  def __walk( self, path ):
+    if not os.path.isdir(path):
+      yield path
+      return
+    for entry in sorted( os.scandir(path), key=lambda entry: entry.name ):
+      if entry.is_dir():
+        yield from self.__walk( entry.path )
+      else:
+        yield entry.path
+
+
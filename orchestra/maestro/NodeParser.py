@@ -7,13 +7,11 @@ from Gaugi import StatusCode, Color, expandFolders
 
 # Connect to DB
 from orchestra.db import Task,Dataset,File,Job
-from orchestra import Status, Signal, getStatus
+from orchestra import Status, Signal, getStatus, getConfig
 from sqlalchemy import and_, or_
-from prettytable import PrettyTable
 
 # common imports
 import glob
-import numpy as np
 import argparse
 import sys,os
 import hashlib
@@ -113,7 +111,18 @@ class NodeParser( Logger ):
   # List datasets
   #
   def list( self ):
+    # Read only (replica if configured). The node heartbeat is checked by the database clock
+    t = self.table( self.__db.getAllNodesStatus( getConfig()['node_heartbeat_timeout'] ) )
+    return (StatusCode.SUCCESS, t)
+
 
+
+  #
+  # Build the table from a list like [ (node, alive) ]
+  #
+  def table( self, nodes ):
+
+    from prettytable import PrettyTable
     t = PrettyTable([
                       Color.CGREEN2 + 'Node'      + Color.CEND,
                       Color.CGREEN2 + 'GPU Slots' + Color.CEND,
@@ -123,17 +132,16 @@ class NodeParser( Logger ):
                       
                       ])
 
-    # Loop over all datasets inside of the username
-    for node in self.__db.getAllNodes():
+    for node, alive in nodes:
 
       t.add_row(  [node.name,
                    '%d/%d'%(node.enabledGPUSlots, node.maxNumberOfGPUSlots),
                    '%d/%d'%(node.enabledCPUSlots, node.maxNumberOfCPUSlots),
                    'master' if node.isMaster() else 'slave',
-                   'online' if node.isAlive() else 'offline',
+                   'online' if alive else 'offline',
                   ] )
 
-    return (StatusCode.SUCCESS, t)
+    return t
 
 
 
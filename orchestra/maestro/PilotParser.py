@@ -8,11 +8,9 @@ import orchestra
 # Connect to DB
 from orchestra import *
 from sqlalchemy import and_, or_
-from prettytable import PrettyTable
 
 # common imports
 import glob
-import numpy as np
 import argparse
 import sys,os
 import hashlib
@@ -38,6 +36,9 @@ class PilotParser( Logger ):
       run_parser.add_argument('-m','--master', action='store_true',
                dest='master', required = False ,
                help = "This is a master branch. One node must be a master.")
+      run_parser.add_argument('--event_driven', action='store_true',
+               dest='event_driven', required = False ,
+               help = "Wake up the pilot when something change into the database (postgres only) instead of polling every 10 seconds.")
 
 
 
@@ -53,7 +54,7 @@ class PilotParser( Logger ):
     # Dataset CLI
     if args.mode == 'pilot':
       if args.option == 'run':
-        status, answer = self.run( args.node, args.master )
+        status, answer = self.run( args.node, args.master, args.event_driven )
         if status.isFailure():
           MSG_FATAL(self, answer)
         else:
@@ -68,14 +69,15 @@ class PilotParser( Logger ):
   #
   # List datasets
   #
-  def run( self, nodename , master):
+  def run( self, nodename , master, event_driven=False):
 
     email = config['email']
     password = config['password']
     module_orchestra_path = os.path.dirname(orchestra.__file__)
 
     # create the postman
-    postman = Postman( email, password , module_orchestra_path+'/mailing/templates')
+    postman = Postman( email, password , module_orchestra_path+'/mailing/templates', sink=config['mail_sink'],
+                       digest_window=config['mail_digest_window'] )
 
     # get the standard schedule state machine
     from orchestra import schedule
@@ -92,7 +94,9 @@ class PilotParser( Logger ):
 
 
     # create the pilot
-    pilot = Pilot(node, self.__db, schedule, postman, node.isMaster() )
+    pilot = Pilot(node, self.__db, schedule, postman, node.isMaster(), event_driven=event_driven,
+                  interval=config['tick_interval'], min_interval=config['tick_min_interval'], max_interval=config['tick_max_interval'],
+                  heartbeat_interval=config['heartbeat_interval'], reconnect_interval=config['reconnect_interval'] )
 
     # create allways two slots (cpu and gpu) by default
     pilot+=Slots(node, 'cpu' , gpu=False )
@@ -106,8 +110,10 @@ class PilotParser( Logger ):
       subject = "[Cluster LPS] (ALARM) Orchestra stop"
       message=traceback.format_exc()
       for user in self.__db.getAllUsers():
-        postman.send( user.email,subject,message)
+        postman.send( user.email,subject,message, kind='alarm')
       print(message)
+      # wait for the delivery before exit
+      postman.finalize()
       return (StatusCode.FATAL, "fatal...")
 
 
@@ -0,0 +1,157 @@
+__all__ = ["TaskMonitor"]
+
+from Gaugi.messenger import Logger
+from Gaugi.messenger.macros import *
+
+from orchestra.enums import Status
+from orchestra.utils import getConfig
+import sys, re, time, datetime
+
+
+# The summaries are written with the time of the transaction start (database clock), so one
+# summary committed late can be older than the last revision seen. Read again all summaries
+# changed inside of this window (seconds) before the last revision.
+REVISION_OVERLAP = 60
+
+# Escape codes (colors) are not allowed by curses
+ANSI_ESCAPE = re.compile( r'\x1b\[[0-9;]*m' )
+
+
+
+#
+# Interactive task list (maestro.py task list -i). After the first load, only the tasks with
+# summary changed since the last revision are read (all nodes are read, since they are few).
+# The tables are drawn in place using curses only when something changed, and the monitor
+# sleeps (waiting for a key) between two refreshes. All tasks are reloaded from time to time
+# to remove the deleted ones.
+#
+class TaskMonitor(Logger):
+
+  def __init__(self, db, username, list_all, interval=None, reload_interval=None):
+    Logger.__init__(self)
+    self.__db = db
+    self.__username = username
+    self.__list_all = list_all
+    config = getConfig()
+    self.__interval = interval if interval else config['monitor_interval']
+    self.__reload_interval = reload_interval if reload_interval else config['monitor_reload_interval']
+    # task id -> (task, histogram)
+    self.__tasks = {}
+    # [ (node, alive) ]
+    self.__nodes = []
+    self.__revision = None
+    self.__reloaded = None
+    self.__updated = None
+
+
+  #
+  # Read the changes. Return True if the tables must be drawn again
+  #
+  def refresh(self):
+
+    # must be read before the tasks, so no change is lost between the two snapshots
+    revision = self.__db.getTaskSummaryRevision( self.__username )
+
+    if self.__revision is None or time.time() - self.__reloaded > self.__reload_interval:
+      tasks = { task.id : (task, histogram) for task, histogram in
+                self.__db.getTaskSummaries( self.__username, self.__list_all ) }
+      self.__reloaded = time.time()
+    else:
+      tasks = dict( self.__tasks )
+      since = self.__revision - datetime.timedelta( seconds=REVISION_OVERLAP )
+      for task, histogram in self.__db.getTaskSummaries( self.__username, since=since ):
+        if self.__list_all or task.status != Status.DONE:
+          tasks[task.id] = (task, histogram)
+        else:
+          tasks.pop( task.id, None )
+    self.__revision = revision
+
+    nodes = self.__db.getAllNodesStatus( getConfig()['node_heartbeat_timeout'] )
+    self.__updated = time.strftime( '%H:%M:%S' )
+
+    changed = self.__key_tasks( tasks ) != self.__key_tasks( self.__tasks ) or \
+              self.__key_nodes( nodes ) != self.__key_nodes( self.__nodes )
+    self.__tasks = tasks
+    self.__nodes = nodes
+    return changed
+
+
+  def __key_tasks(self, tasks):
+    return { id : (task.taskName, task.queueName, task.status, sorted(histogram.items()))
+             for id, (task, histogram) in tasks.items() }
+
+
+  def __key_nodes(self, nodes):
+    return [ (node.name, node.enabledGPUSlots, node.maxNumberOfGPUSlots, node.enabledCPUSlots,
+              node.maxNumberOfCPUSlots, node.master, alive) for node, alive in nodes ]
+
+
+  #
+  # All lines of the node and task tables (without colors)
+  #
+  def render(self):
+    from orchestra.maestro import TaskParser, NodeParser
+    t_nodes = NodeParser(self.__db).table( self.__nodes )
+    t_tasks = TaskParser(self.__db).table( [ self.__tasks[id] for id in sorted(self.__tasks.keys()) ] )
+    return ANSI_ESCAPE.sub( '', str(t_nodes) + '\n' + str(t_tasks) ).split('\n')
+
+
+  #
+  # Run until q (or ctrl+c) is pressed. Without terminal, print the tables only once
+  #
+  def run(self):
+    if not sys.stdout.isatty():
+      self.refresh()
+      print( '\n'.join( self.render() ) )
+      return
+    import curses
+    try:
+      curses.wrapper( self.__loop )
+    except KeyboardInterrupt:
+      pass
+
+
+  def __loop(self, screen):
+    import curses
+    try:
+      curses.curs_set(0)
+    except curses.error:
+      pass
+    # getch will sleep until one key is pressed or the interval expires
+    screen.timeout( int(self.__interval * 1000) )
+    lines = None
+    refresh = True
+    while True:
+      if refresh:
+        changed = self.refresh()
+        if changed or lines is None:
+          lines = self.render()
+      self.__draw( screen, lines )
+      key = screen.getch()
+      if key in ( ord('q'), ord('Q') ):
+        break
+      # other keys (e.g. resize) only draw again. The database is read when the interval expires
+      refresh = key == -1
+
+
+  #
+  # Only the characters changed since the last draw are sent to the terminal by curses
+  #
+  def __draw(self, screen, lines):
+    import curses
+    height, width = screen.getmaxyx()
+    screen.erase()
+    for y, line in enumerate( lines[:height-1] ):
+      self.__addstr( screen, y, line, width )
+    footer = "Updated at %s (every %d seconds). Press q to quit." % (self.__updated, self.__interval)
+    self.__addstr( screen, height-1, footer, width, curses.A_REVERSE )
+    screen.refresh()
+
+
+  def __addstr(self, screen, y, line, width, attr=0):
+    import curses
+    try:
+      screen.addnstr( y, 0, line, max(width-1, 0), attr )
+    except curses.error:
+      # the terminal is too small
+      pass
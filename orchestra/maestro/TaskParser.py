@@ -6,17 +6,17 @@ from Gaugi.messenger.macros import *
 from Gaugi import StatusCode, Color, expandFolders, progressbar
 
 # Connect to DB
-from orchestra.db import Task,Dataset,File,Job
+from orchestra.db import Task,Dataset,File,Job,Worker,TaskSummary
 from orchestra import Status, Signal, getStatus
-from sqlalchemy import and_, or_
-from prettytable import PrettyTable
+from sqlalchemy import and_, or_, desc
 
 # common imports
 import glob
-import numpy as np
 import argparse
 import sys,os
 import hashlib
+import shutil
+import subprocess
 
 from orchestra.utils import getConfig
 config = getConfig()
@@ -112,6 +112,8 @@ class TaskParser(Logger):
                     help = "Upper task id limit to apply on the loop", type=int, default=None)
       delete_parser.add_argument('--remove', action='store_true', dest='remove', required=False,
                     help = "Remove all files for this task into the storage. Beware when use this flag becouse you will lost your data too.")
+      delete_parser.add_argument('--background', action='store_true', dest='background', required=False,
+                    help = "Remove the storage files (--remove) using a background process and return immediately.")
       delete_parser.add_argument('--force', action='store_true', dest='force', required=False,
                     help = "Force delete.")
 
@@ -224,7 +226,7 @@ class TaskParser(Logger):
       # delete option
       elif args.option == 'delete':
         task_id_list = get_task_ids(args)
-        status , answer = self.delete(task_id_list, remove=args.remove, force=args.force)
+        status , answer = self.delete(task_id_list, remove=args.remove, force=args.force, background=args.background)
         if status.isFailure():
           MSG_FATAL(self, answer)
         else:
@@ -366,7 +368,7 @@ class TaskParser(Logger):
         task.setSignal(Signal.WAITING)
         task.setStatus(Status.HOLD)
 
-        configFiles = self.__db.getDataset(username, configFile).getAllFiles()
+        configDataset = self.__db.getDataset(username, configFile)
 
         _dataFile = self.__db.getDataset(username, dataFile).getAllFiles()[0].getPath()
 
@@ -375,32 +377,36 @@ class TaskParser(Logger):
         for key in secondaryDS.keys():
           _secondaryDS[key] = self.__db.getDataset(username, secondaryDS[key]).getAllFiles()[0].getPath()
 
-        offset_job_id = self.__db.generateId(Job)
-        
-        for idx, file in progressbar( enumerate(configFiles), len(configFiles), prefix='Creating...' ):
+        # The config files are read and the jobs are inserted in chunks while templating
+        def generate_jobs():
+          for idx, _configFile in enumerate( self.__db.getAllFilePaths(configDataset) ):
 
-          _outputFile = outputFile+ '/job_configId_%d'%idx
+            _outputFile = outputFile+ '/job_configId_%d'%idx
 
-          _configFile = file.getPath()
+            command = execCommand
+            command = command.replace( '%DATA' , _dataFile  )
+            command = command.replace( '%IN'   , _configFile)
+            command = command.replace( '%OUT'  , _outputFile)
 
-          command = execCommand
-          command = command.replace( '%DATA' , _dataFile  )
-          command = command.replace( '%IN'   , _configFile)
-          command = command.replace( '%OUT'  , _outputFile)
+            for key in _secondaryDS:
+              command = command.replace( key  , _secondaryDS[key])
 
-          for key in _secondaryDS:
-            command = command.replace( key  , _secondaryDS[key])
+            yield { 'configFilePath':_configFile, 'configId':idx, 'execArgs':command, 'priority':-1,
+                    'status':'assigned' if bypass else 'registered' }
 
-          job = self.__db.createJob( task, _configFile, idx, execArgs=command, priority=-1, id = offset_job_id+idx )
-          job.setStatus('assigned' if bypass else 'registered')
 
+        njobs = self.__db.countFiles( configDataset )
+        if self.__db.createJobs( task, progressbar( generate_jobs(), njobs, prefix='Creating...' ) ) is None:
+          self.__db.session().rollback()
+          return (StatusCode.FATAL, "Not possible to create the jobs.")
 
         task.setStatus('registered')
 
         # Test locally before send to the database
-        if self.__test_job_locally( task.getAllJobs()[0] ):
+        if self.__test_job_locally( self.__db.session().query(Job).filter(Job.taskId==task.id).order_by(Job.id).first() ):
             self.__db.commit()
         else:
+            self.__db.session().rollback()
             return (StatusCode.FATAL, "Local test failed.")
 
       except Exception as e:
@@ -411,40 +417,70 @@ class TaskParser(Logger):
 
 
 
-  def delete( self, task_id_list, remove=False, force=False ):
+  def delete( self, task_id_list, remove=False, force=False, background=False ):
 
+    # Get all tasks in one shot and check all of them before delete anything
+    tasks = { task.id : task for task in self.__db.session().query(Task).filter(Task.id.in_(task_id_list)).all() }
 
     for id in task_id_list:
-       
+      if not id in tasks.keys():
+        return (StatusCode.FATAL, "The task with id (%d) does not exist into the data base"%id )
+      # Check possible status before continue
+      if not force:
+        if not tasks[id].getStatus() in [Status.BROKEN, Status.KILLED, Status.FINALIZED, Status.DONE]:
+          return (StatusCode.FATAL, "The task with current status %s can not be deleted. The task must be in done, finalized, killed or broken status."% tasks[id].getStatus() )
+
+    for id, task in tasks.items():
+      MSG_INFO( self, 'Delete task (%d) with name: %s', id, task.taskName)
+
+    # The storage paths must be read before delete the tasks
+    paths = [ task.getTheOutputStoragePath() for task in tasks.values() ]
+
+    # remove all jobs that allow to these tasks (in chunks)
+    try:
+      total = self.__db.deleteAll( Job, Job.taskId.in_(list(tasks.keys())) )
+      MSG_INFO( self, "Removed %d jobs.", total )
+    except Exception as e:
+      MSG_ERROR(self,e)
+      self.__db.session().rollback()
+      return (StatusCode.FATAL, "Not possible to remove the jobs.")
+
+    # remove all tasks using one statement
+    try:
+      self.__db.session().query(TaskSummary).filter(TaskSummary.taskId.in_(list(tasks.keys()))).delete( synchronize_session=False )
+      self.__db.session().query(Task).filter(Task.id.in_(list(tasks.keys()))).delete( synchronize_session=False )
+      self.__db.commit()
+    except Exception as e:
+      MSG_ERROR(self,e)
+      self.__db.session().rollback()
+      return (StatusCode.FATAL, "Not possible to remove the tasks.")
+
+    if remove:
+      self.__purge( paths, background )
 
-        # Get task by id
-        task = self.__db.session().query(Task).filter(Task.id==id).first()
-        if not task:
-          return (StatusCode.FATAL, "The task with id (%d) does not exist into the data base"%id )
-
-        MSG_INFO( self, 'Delete task (%d) with name: %s', id, task.taskName)
-        # Check possible status before continue
-        if not force:
-          if not task.getStatus() in [Status.BROKEN, Status.KILLED, Status.FINALIZED, Status.DONE]:
-            return (StatusCode.FATAL, "The task with current status %s can not be deleted. The task must be in done, finalized, killed or broken status."% task.getStatus() )
+    return (StatusCode.SUCCESS, "Succefully deleted.")
 
-        # remove all jobs that allow to this task
-        try:
-          self.__db.session().query(Job).filter(Job.taskId==id).delete()
-          self.__db.commit()
-        except Exception as e:
-          MSG_WARNING(self,e)
 
 
-        # remove the task table
-        try:
-          self.__db.session().query(Task).filter(Task.id==id).delete()
-          self.__db.commit()
-        except Exception as e:
-          MSG_WARNING(self,e)
+  #
+  # Remove all task directories from the storage. In background mode, a detached process
+  # will remove them and this method will return immediately.
+  #
+  def __purge( self, paths, background=False ):
+
+    paths = [ path for path in paths if path and os.path.exists(path) ]
+    if not paths:
+      return
+    if background:
+      MSG_INFO( self, "Removing %d task directories from the storage in background.", len(paths) )
+      subprocess.Popen( ['rm', '-rf'] + paths, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                        start_new_session=True )
+    else:
+      for path in paths:
+        MSG_INFO( self, "Removing %s from the storage.", path )
+        shutil.rmtree( path, ignore_errors=True )
 
 
-    return (StatusCode.SUCCESS, "Succefully deleted.")
 
 
 
@@ -452,83 +488,67 @@ class TaskParser(Logger):
 
 
 
+  def list( self, username, list_all, interactive=True ):
 
+    session = self.__db.readonly()
+    user = session.query(Worker.id).filter(Worker.username==username).first()
+    session.commit()
+    if user is None:
+      return (StatusCode.FATAL, 'The username does not exist into the database.' )
 
-  def list( self, username, list_all, interactive=True ):
+    if interactive:
+      # Only the changed tasks are read again and the screen is updated in place
+      from orchestra.maestro.TaskMonitor import TaskMonitor
+      TaskMonitor(self.__db, username, list_all).run()
+      return (StatusCode.SUCCESS, "")
+    else:
+      # Read only (replica if configured) in a new snapshot. The number of jobs by status
+      # come from the task summary, so no job will be loaded
+      t = self.table( self.__db.getTaskSummaries( username, list_all ) )
+      return (StatusCode.SUCCESS, t)
 
 
-    def count( jobs ):
-      status_list = [Status.REGISTERED, Status.ASSIGNED, Status.TESTING, Status.RUNNING, Status.DONE, Status.FAILED, Status.KILL, Status.KILLED, Status.BROKEN]
-      total = { str(key):0 for key in status_list }
-      for job in jobs:
-        for s in status_list:
-          if job.status==s: total[str(s)]+=1
-      return total
-
-    def get_table( username, list_all ):
-      user = self.__db.getUser(username)
-      tasks = user.getAllTasks()
-      t = PrettyTable([
-
-                        Color.CGREEN2 + 'TaskID'      + Color.CEND,
-                        Color.CGREEN2 + 'Taskname'    + Color.CEND,
-                        Color.CGREEN2 + 'Queue'       + Color.CEND,
-                        Color.CGREEN2 + 'Registered'  + Color.CEND,
-                        Color.CGREEN2 + 'Assigned'    + Color.CEND,
-                        Color.CGREEN2 + 'Testing'     + Color.CEND,
-                        Color.CGREEN2 + 'Running'     + Color.CEND,
-                        Color.CRED2   + 'Failed'      + Color.CEND,
-                        Color.CGREEN2 + 'Done'        + Color.CEND,
-                        Color.CRED2   + 'kill'        + Color.CEND,
-                        Color.CRED2   + 'killed'      + Color.CEND,
-                        Color.CRED2   + 'broken'      + Color.CEND,
-                        Color.CGREEN2 + 'Status'      + Color.CEND,
-                        ])
-
-      for task in tasks:
-        jobs = task.getAllJobs()
-        if not list_all and (task.status == 'done'):
-          continue
-        total = count(jobs)
-        id            = task.id
-        taskName      = task.taskName
-        queue         = task.queueName
-        registered    = total[ Status.REGISTERED]
-        assigned      = total[ Status.ASSIGNED  ] 
-        testing       = total[ Status.TESTING   ] 
-        running       = total[ Status.RUNNING   ] 
-        done          = total[ Status.DONE      ] 
-        failed        = total[ Status.FAILED    ] 
-        kill          = total[ Status.KILL      ] 
-        killed        = total[ Status.KILLED    ] 
-        broken        = total[ Status.BROKEN    ] 
-        status        = task.status
-        t.add_row(  [task.id, taskName, queue, registered,  assigned, testing, running, failed,  done, kill, killed, broken, getStatus(status)] )
-      return t
 
+  #
+  # Build the table from a list like [ (task, {status : total}) ]
+  #
+  def table( self, tasks ):
 
-    if not username in [ user.getUserName() for user in self.__db.getAllUsers() ]:
-      return (StatusCode.FATAL, 'The username does not exist into the database.' )
+    from prettytable import PrettyTable
+    t = PrettyTable([
 
+                      Color.CGREEN2 + 'TaskID'      + Color.CEND,
+                      Color.CGREEN2 + 'Taskname'    + Color.CEND,
+                      Color.CGREEN2 + 'Queue'       + Color.CEND,
+                      Color.CGREEN2 + 'Registered'  + Color.CEND,
+                      Color.CGREEN2 + 'Assigned'    + Color.CEND,
+                      Color.CGREEN2 + 'Testing'     + Color.CEND,
+                      Color.CGREEN2 + 'Running'     + Color.CEND,
+                      Color.CRED2   + 'Failed'      + Color.CEND,
+                      Color.CGREEN2 + 'Done'        + Color.CEND,
+                      Color.CRED2   + 'kill'        + Color.CEND,
+                      Color.CRED2   + 'killed'      + Color.CEND,
+                      Color.CRED2   + 'broken'      + Color.CEND,
+                      Color.CGREEN2 + 'Status'      + Color.CEND,
+                      ])
 
-    
-    if interactive:
-        from orchestra.utils import Clock
-        from orchestra.maestro import NodeParser
-        SECONDS=1.
-        clock = Clock(10*SECONDS)
-        nodes = NodeParser(self.__db)
-        while True:
-            if clock():
-                import os
-                _, t_nodes = nodes.list()
-                t_tasks = get_table(username, list_all)
-                os.system("clear")
-                print(t_nodes)
-                print(t_tasks)
-    else:
-        t = get_table(username, list_all)
-        return (StatusCode.SUCCESS, t)
+    for task, histogram in tasks:
+      total = { s : histogram.get(s, 0) for s in TaskSummary.status_list }
+      id            = task.id
+      taskName      = task.taskName
+      queue         = task.queueName
+      registered    = total[ Status.REGISTERED]
+      assigned      = total[ Status.ASSIGNED  ] 
+      testing       = total[ Status.TESTING   ] 
+      running       = total[ Status.RUNNING   ] 
+      done          = total[ Status.DONE      ] 
+      failed        = total[ Status.FAILED    ] 
+      kill          = total[ Status.KILL      ] 
+      killed        = total[ Status.KILLED    ] 
+      broken        = total[ Status.BROKEN    ] 
+      status        = task.status
+      t.add_row(  [task.id, taskName, queue, registered,  assigned, testing, running, failed,  done, kill, killed, broken, getStatus(status)] )
+    return t
 
 
 
@@ -582,6 +602,7 @@ class TaskParser(Logger):
 
   def queue( self , queuename ):
 
+    from prettytable import PrettyTable
     t = PrettyTable([
                       Color.CGREEN2 + 'username'    + Color.CEND,
                       Color.CGREEN2 + 'Queue'       + Color.CEND,
@@ -591,18 +612,22 @@ class TaskParser(Logger):
                       Color.CGREEN2 + 'Status'      + Color.CEND,
                       ])
 
-    assigned_jobs = self.__db.session().query(Job).filter(  and_( Job.status==Status.ASSIGNED ,
-        Job.queueName==queuename) ).order_by(desc(Job.priority)).limit(10).with_for_update().all()
+    # Read only (replica if configured) and without locks. Both lists come from the same snapshot
+    session = self.__db.readonly()
+    assigned_jobs = session.query(Job).filter(  and_( Job.status==Status.ASSIGNED ,
+        Job.queueName==queuename) ).order_by(desc(Job.priority)).limit(10).all()
     assigned_jobs.reverse()
 
-    running_jobs = self.__db.session().query(Job).filter(  and_( Job.status==Status.RUNNING ,
-        Job.queueName==queuename) ).order_by(desc(Job.priority)).with_for_update().all()
+    running_jobs = session.query(Job).filter(  and_( Job.status==Status.RUNNING ,
+        Job.queueName==queuename) ).order_by(desc(Job.priority)).all()
     running_jobs.reverse()
 
     for job in running_jobs:
       t.add_row(  [job.getUserName(), job.getQueueName(), job.getTaskName(), job.configId, job.getPriority(), getStatus(job.status)] )
     for job in assigned_jobs:
       t.add_row(  [job.getUserName(), job.getQueueName(), job.getTaskName(), job.configId, job.getPriority(), getStatus(job.status)] )
+    # end the snapshot
+    session.commit()
 
     return (StatusCode.SUCCESS, t)
 
@@ -716,19 +741,24 @@ class TaskParser(Logger):
           _secondaryDS[key] = self.__db.getDataset(username, secondaryDS[key]).getAllFiles()[0].getPath()
 
 
-        for idx, _tunedFile in enumerate(tunedFiles):
+        def generate_jobs():
+          for idx, _tunedFile in enumerate(tunedFiles):
+
+            _outputFile = outputFile+ '/job_configId_%d'%idx
 
-          _outputFile = outputFile+ '/job_configId_%d'%idx
+            command = execCommand
+            command = command.replace( '%DATA' , _dataFile  )
+            command = command.replace( '%IN'   , _tunedFile)
+            command = command.replace( '%OUT'  , _outputFile)
 
-          command = execCommand
-          command = command.replace( '%DATA' , _dataFile  )
-          command = command.replace( '%IN'   , _tunedFile)
-          command = command.replace( '%OUT'  , _outputFile)
+            for key in _secondaryDS:
+              command = command.replace( key  , _secondaryDS[key])
 
-          for key in _secondaryDS:
-            command = command.replace( key  , _secondaryDS[key])
+            yield { 'configFilePath':_tunedFile, 'configId':idx, 'execArgs':command, 'priority':-1 }
 
-          job = self.__db.createJob( task, _tunedFile, idx, execArgs=command, priority=-1 )
+        if self.__db.createJobs( task, generate_jobs() ) is None:
+          self.__db.session().rollback()
+          return (StatusCode.FATAL, "Not possible to create the jobs.")
 
         task.setStatus('registered')
         self.__db.commit()
@@ -10,11 +10,9 @@ from orchestra.db import Task,Dataset,File,Job
 from orchestra import Status, Signal, getStatus
 from orchestra.db.models import *
 from sqlalchemy import and_, or_
-from prettytable import PrettyTable
 
 # common imports
 import glob
-import numpy as np
 import argparse
 import sys,os
 import hashlib
@@ -108,6 +106,7 @@ class UserParser( Logger ):
   #
   def list( self, username ):
 
+    from prettytable import PrettyTable
     t = PrettyTable([ Color.CGREEN2 + 'Username' + Color.CEND,
                       Color.CGREEN2 + 'email'  + Color.CEND])
 
@@ -133,21 +132,13 @@ class UserParser( Logger ):
     MSG_WARNING(self, "Not implemented yet." )
 
 
+  #
+  # Create (or migrate) all tables and indexes. Safe to be called more than once
+  #
   def init(self):
 
-    from orchestra import getConfig
-
-    from sqlalchemy import create_engine
-    from sqlalchemy.orm import sessionmaker
-    
-    config = getConfig()
-    engine = create_engine(config["postgres"])
-    Session = sessionmaker(bind=engine)
-    session = Session()
-    Base.metadata.create_all(engine)
-    session.commit()
-    session.close()
-
+    if not self.__db.migrate():
+      return (StatusCode.FATAL, "Failed to initialize the database.")
 
     return (StatusCode.SUCCESS, "Successfully initialized." )
 
@@ -8,6 +8,10 @@ from . import TaskParser
 __all__.extend( TaskParser.__all__ )
 from .TaskParser import *
 
+from . import TaskMonitor
+__all__.extend( TaskMonitor.__all__ )
+from .TaskMonitor import *
+
 from . import UserParser
 __all__.extend( UserParser.__all__ )
 from .UserParser import *
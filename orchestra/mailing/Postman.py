@@ -3,59 +3,264 @@ __all__ = ['Postman']
 from Gaugi import Logger
 from Gaugi.messenger.macros import *
 
-from smtplib import SMTP
-from email.mime.application import MIMEApplication
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from jinja2 import Environment, FileSystemLoader
+import os, sys, time, threading, queue
 
-import os, sys
 
+#
+# Deliver the notifications in background. The send method only put the message into a queue
+# and return. A worker thread groups all messages of the same recipient arrived inside of the
+# digest window into one email and sends them using one persistent SMTP connection. Failed
+# deliveries are retried with exponential backoff. If sink is a directory, the messages are
+# written there (maildir format) instead of being sent (useful for testing).
+#
 class Postman (Logger):
 
-  def __init__ (self, email, password,  templates):
+  # Template used by each notification type. The digest template renders many messages at once
+  templates = {
+    'task_done'      : 'templates/task_done.html',
+    'task_broken'    : 'templates/task_broken.html',
+    'task_finalized' : 'templates/task_finalized.html',
+    'task_killed'    : 'templates/task_killed.html',
+    'alarm'          : 'templates/alarm.html',
+    'digest'         : 'templates/task_digest.html',
+  }
+
+  def __init__ (self, email, password,  templates, server='smtp.gmail.com', port=587, sink=None,
+                digest_window=2., max_retries=5, retry_interval=5., idle_timeout=60.):
     Logger.__init__(self)
     self.__myEmail = email
     self.__myPassword = password
-    self.__smtpServer = 'smtp.gmail.com'
-    self.__smtpPort = 587
-    self.__env = Environment(loader=FileSystemLoader(templates))
+    self.__smtpServer = server
+    self.__smtpPort = port
+    self.__sink = sink
+    # seconds to wait for more messages of the same recipient
+    self.__digest_window = digest_window
+    self.__max_retries = max_retries
+    self.__retry_interval = retry_interval
+    # close the smtp connection if not used by this number of seconds
+    self.__idle_timeout = idle_timeout
+    # jinja2 is only imported when a postman is created (pilot), never by the CLI
+    from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+    # The templates are compiled only once (the bytecode is cached on disk between pilots)
+    # and never checked again for changes
+    self.__env = Environment(loader=FileSystemLoader(templates), auto_reload=False,
+                             bytecode_cache=FileSystemBytecodeCache(), cache_size=-1)
+    self.__templates = { kind : self.__env.get_template(name) for kind, name in self.templates.items() }
+    self.__queue = queue.Queue()
+    self.__thread = None
+    self.__server = None
+    self.__lock = threading.Lock()
+    # Set by finalize to give up all retries
+    self.__stop = threading.Event()
 
 
-  def __send (self, to_email, subject, bodyContent, logs=[]):
+  #
+  # Put the message into the delivery queue
+  #
+  def send (self, to_email, subject, message, logs=[], kind='task_done'):
+    if kind not in self.__templates:
+      MSG_WARNING( self, "Notification type %s not registered. Using task_done.", kind )
+      kind = 'task_done'
+    self.__start()
+    self.__queue.put( (to_email, subject, message, list(logs), kind) )
 
-    try:
-      # Building the e-mail
-      message = MIMEMultipart()
-      message['Subject'] = subject
-      message['From'] = self.__myEmail
-      message['To'] = to_email
-      message.attach(MIMEText(bodyContent, 'html'))
-      msgBody = message.as_string()
-      for i, text in enumerate(logs):
-        part = MIMEApplication(
-          text,
-          Name="LogFile_{}".format(i)
-        )
-        part['Content-Disposition'] = 'attachment; filename="%s"' % "LogFile_{}".format(i)
-        message.attach(part)
-      # Authenticating
-      server = SMTP(self.__smtpServer, self.__smtpPort)
-      server.starttls()
-      server.login(self.__myEmail, self.__myPassword)
-      # Sending
-      server.sendmail(self.__myEmail, to_email, msgBody.encode('utf-8'))
-      # Quitting
-      server.quit()
-    except Exception as e:
-      MSG_WARNING(self, e)
+
+  #
+  # Block until all messages in the queue were delivered (or discarded)
+  #
+  def flush (self):
+    if self.__thread is not None:
+      self.__queue.join()
+
+
+  #
+  # Deliver all pending messages and stop the worker. After timeout seconds (e.g. the smtp server
+  # is not reachable), the retries are stopped and all messages not delivered yet are dropped.
+  #
+  def finalize (self, timeout=30.):
+    if self.__thread is not None:
+      self.__queue.put( None )
+      self.__thread.join( timeout )
+      if self.__thread.is_alive():
+        self.__stop.set()
+        dropped = 0
+        while True:
+          try:
+            item = self.__queue.get_nowait()
+          except queue.Empty:
+            break
+          self.__queue.task_done()
+          dropped += 1 if item is not None else 0
+        MSG_ERROR( self, "Not possible to deliver all notifications in %d seconds. Stopping the retries and dropping %d queued messages.", timeout, dropped )
+        self.__thread.join( 1. )
+      if self.__thread.is_alive():
+        # still blocked by the smtp server. The thread is a daemon and will not hold the exit
+        return
+      self.__thread = None
+    self.__disconnect()
+
+
+  def __start (self):
+    with self.__lock:
+      if self.__thread is None:
+        self.__stop.clear()
+        self.__thread = threading.Thread( target=self.__loop, name='postman', daemon=True )
+        self.__thread.start()
+
+
+  #
+  # Worker loop
+  #
+  def __loop (self):
+
+    while True:
+      try:
+        item = self.__queue.get( timeout=self.__idle_timeout )
+      except queue.Empty:
+        self.__disconnect()
+        continue
+
+      # Collect all messages arrived inside of the digest window
+      items = [item]
+      stop = item is None
+      deadline = time.time() + self.__digest_window
+      while not stop:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          break
+        try:
+          item = self.__queue.get( timeout=remaining )
+        except queue.Empty:
+          break
+        items.append( item )
+        stop = item is None
+
+      try:
+        self.__deliver( [ item for item in items if item is not None ] )
+      except Exception as e:
+        MSG_ERROR( self, "Not possible to deliver the notifications: %s", e )
+      finally:
+        for _ in items:
+          self.__queue.task_done()
+
+      if stop:
+        break
+
+
+  #
+  # Send one email for each recipient
+  #
+  def __deliver (self, items):
+
+    # Keep the arrival order of each recipient
+    digests = {}
+    for to_email, subject, message, logs, kind in items:
+      digests.setdefault( to_email, [] ).append( (subject, message, logs, kind) )
+
+    for to_email, messages in digests.items():
+      if len(messages) == 1:
+        subject, message, logs, kind = messages[0]
+        body = self.render( kind, message )
+      else:
+        subject = "[LPS Cluster] %d notifications" % len(messages)
+        body = self.render_digest( [ (kind, subject, message) for subject, message, _, kind in messages ] )
+        logs = [ log for _, _, _logs, _ in messages for log in _logs ]
+      self.__retry( to_email, subject, body, logs )
 
 
-  def send (self, to_email, subject, message):
-    template = self.__env.get_template('templates/task_notification.html')
+  #
+  # Render the body of one notification
+  #
+  def render (self, kind, message):
     data = {}
     data['message'] = message
-    output = template.render(data=data)
-    self.__send(to_email, subject, output)
+    return self.__templates[kind].render(data=data)
+
+
+  #
+  # Render many notifications (kind, subject, message) into one body
+  #
+  def render_digest (self, messages):
+    data = {}
+    data['messages'] = [ {'kind':kind, 'subject':subject, 'message':message} for kind, subject, message in messages ]
+    return self.__templates['digest'].render(data=data)
+
+
+  #
+  # Try to send the email until max_retries with exponential backoff
+  #
+  def __retry (self, to_email, subject, bodyContent, logs):
+
+    attempts = 0
+    for attempt in range( self.__max_retries ):
+      if self.__stop.is_set():
+        break
+      attempts += 1
+      try:
+        self.__send( to_email, subject, bodyContent, logs )
+        return True
+      except Exception as e:
+        # the connection may be broken
+        self.__disconnect()
+        if attempt == self.__max_retries-1:
+          MSG_WARNING( self, "Not possible to send the email to %s (%s).", to_email, e )
+          break
+        wait = self.__retry_interval * (2**attempt)
+        MSG_WARNING( self, "Not possible to send the email to %s (%s). Retrying in %1.1f seconds...", to_email, e, wait )
+        # finalize will interrupt the wait
+        self.__stop.wait( wait )
+
+    MSG_ERROR( self, "Discarding the email to %s after %d attempts.", to_email, attempts )
+    return False
+
+
+  def __send (self, to_email, subject, bodyContent, logs=[]):
+
+    from email.mime.application import MIMEApplication
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    # Building the e-mail
+    message = MIMEMultipart()
+    message['Subject'] = subject
+    message['From'] = self.__myEmail
+    message['To'] = to_email
+    message.attach(MIMEText(bodyContent, 'html'))
+    for i, text in enumerate(logs):
+      part = MIMEApplication(
+        text,
+        Name="LogFile_{}".format(i)
+      )
+      part['Content-Disposition'] = 'attachment; filename="%s"' % "LogFile_{}".format(i)
+      message.attach(part)
+
+    if self.__sink:
+      import mailbox
+      mailbox.Maildir( self.__sink, create=True ).add( message )
+      return
+
+    # Sending
+    self.__connect().sendmail(self.__myEmail, to_email, message.as_string().encode('utf-8'))
+
+
+  #
+  # Open (only once) the smtp connection
+  #
+  def __connect (self):
+    if self.__server is None:
+      from smtplib import SMTP
+      server = SMTP(self.__smtpServer, self.__smtpPort, timeout=30)
+      # Authenticating
+      server.starttls()
+      server.login(self.__myEmail, self.__myPassword)
+      self.__server = server
+    return self.__server
 
 
+  def __disconnect (self):
+    if self.__server is not None:
+      try:
+        self.__server.quit()
+      except Exception:
+        pass
+      self.__server = None
@@ -1,14 +1,22 @@
 
-__all__ = ["Clock", "getStatus", "getEnv", "getConfig"]
+__all__ = ["Clock", "getStatus", "getEnv", "getConfig", "Config"]
 
 from Gaugi import Color
-import time, os
+import time, os, json, select
 
 
+#
+# Clock with an adaptive interval. The interval starts in maxseconds and can be shortened
+# to minseconds (speedup) or increased by factor until backoffseconds (backoff).
+#
 class Clock(object):
 
-  def __init__( self , maxseconds ):
+  def __init__( self , maxseconds, minseconds=None, backoffseconds=None, factor=2. ):
     self.__maxseconds=maxseconds
+    self.__minseconds=minseconds if minseconds is not None else maxseconds
+    self.__backoffseconds=backoffseconds if backoffseconds is not None else maxseconds
+    self.__factor=factor
+    self.__interval=maxseconds
     self.__then = None
 
 
@@ -16,7 +24,7 @@ class Clock(object):
 
     # Always return false since we considere that the current
     # time never will go to the end (infinite)
-    if self.__maxseconds is None:
+    if self.__interval is None:
       return False
 
     if not self.__then:
@@ -24,7 +32,7 @@ class Clock(object):
       return False
     else:
       now = time.time()
-      if (now-self.__then) > self.__maxseconds:
+      if (now-self.__then) > self.__interval:
         # reset the time
         self.__then = None
         return True
@@ -33,6 +41,57 @@ class Clock(object):
   def reset(self):
     self.__then=None
 
+  def interval(self):
+    return self.__interval
+
+  #
+  # Seconds until the next deadline. The clock starts to count if not started yet
+  #
+  def remaining(self):
+    if self.__interval is None:
+      return None
+    if not self.__then:
+      self.__then = time.time()
+    return max( 0., self.__interval - (time.time()-self.__then) )
+
+  #
+  # Seconds until the shortest interval since the last reset (used to debounce the wake ups)
+  #
+  def cooldown(self):
+    if self.__interval is None:
+      return 0.
+    if not self.__then:
+      self.__then = time.time()
+    return max( 0., self.__minseconds - (time.time()-self.__then) )
+
+  #
+  # Sleep until the next deadline (or at most limit seconds) instead of spinning. If file
+  # descriptors are given, wake up as soon as one of them is ready and return True
+  #
+  def wait(self, limit=None, fds=[]):
+    remaining = self.remaining()
+    if limit is not None:
+      remaining = min( remaining, limit ) if remaining is not None else limit
+    if fds:
+      return len( select.select( fds, [], [], remaining )[0] ) > 0
+    if remaining:
+      time.sleep( remaining )
+    return False
+
+  # Use the shortest interval
+  def speedup(self):
+    if self.__interval is not None:
+      self.__interval = self.__minseconds
+
+  # Increase the interval exponentially until the backoff limit
+  def backoff(self):
+    if self.__interval is not None:
+      self.__interval = min( max(self.__interval, self.__maxseconds)*self.__factor, self.__backoffseconds )
+
+  # Back to the default interval
+  def restore(self):
+    self.__interval = self.__maxseconds
+
 
 
 def getStatus(status):
@@ -70,18 +129,135 @@ def getEnv( name ):
 
 
 
-def getConfig():
+#
+# Process wide configuration loaded from $HOME/.orchestra.json. The file is parsed again only
+# when its modification time change (checked at most once per second). Any key can be
+# overridden by an environment variable like ORCHESTRA_<KEY> (e.g. ORCHESTRA_POSTGRES).
+#
+class Config(object):
+
+  # Typed settings and their default values
+  defaults = {
+    # file created by the job to tell that it finished with success
+    "job_complete_file_name" : ".complete",
+    # pilot tick interval (seconds) and its adaptive limits
+    "tick_interval"          : 10.,
+    "tick_min_interval"      : 1.,
+    "tick_max_interval"      : 30.,
+    # seconds without ping before a running job (or a node) is considered dead
+    "job_heartbeat_timeout"  : 30.,
+    "node_heartbeat_timeout" : 60.,
+    # seconds between two heartbeats of the jobs running into a node (and the node)
+    "heartbeat_interval"     : 10.,
+    # job_heartbeat_timeout for each queue (e.g. {"gpu": 120})
+    "queue_heartbeat_timeout": {},
+    # read only database used by the list commands (e.g. postgres://...replica). Primary if None
+    "postgres_replica"       : None,
+    # database connection pool (seconds for pool_recycle and statement_timeout, 0 to disable)
+    "pool_size"              : 5,
+    "max_overflow"           : 10,
+    "pool_recycle"           : 3600.,
+    "statement_timeout"      : 0.,
+    # seconds to wait before reconnect after a database failure into the pilot
+    "reconnect_interval"     : 10.,
+    # static gpu devices of this node (number, indices or list of dicts). Discovered if None
+    "gpus"                   : None,
+    # write the notifications into this maildir instead of sending them (testing)
+    "mail_sink"              : None,
+    # seconds to group the notifications of the same user into one email
+    "mail_digest_window"     : 2.,
+    # seconds between two refreshes of the interactive task list (and between two full reloads)
+    "monitor_interval"       : 10.,
+    "monitor_reload_interval": 300.,
+  }
+
+
+  def __init__( self, fname=None, check_interval=1. ):
+    self.__fname = fname
+    self.__check_interval = check_interval
+    self.__checked = None
+    self.__mtime = None
+    self.__data = {}
+
+
+  def fname(self):
+    return self.__fname if self.__fname else getEnv("HOME")+'/.orchestra.json'
 
-  # default
-  fname = getEnv("HOME")+'/.orchestra.json'
-  import json
-  try:
-    with open(fname,'r') as f:
-      data = json.load(f)
-      return data
-  except OSError as e:
-    print(e)
-    print("Could not open/read file: %s" % fname)
+
+  #
+  # Parse the file again only if it changed since the last read
+  #
+  def __update(self):
+
+    now = time.time()
+    if self.__checked is not None and (now - self.__checked) < self.__check_interval:
+      return
+    self.__checked = now
+
+    fname = self.fname()
+    try:
+      mtime = os.stat(fname).st_mtime
+    except OSError as e:
+      if self.__mtime != -1:
+        print(e)
+        print("Could not open/read file: %s" % fname)
+        self.__mtime = -1
+        self.__data = {}
+      return
+
+    if mtime != self.__mtime:
+      try:
+        with open(fname,'r') as f:
+          self.__data = json.load(f)
+        self.__mtime = mtime
+      except (OSError, ValueError) as e:
+        print(e)
+        print("Could not open/read file: %s" % fname)
+
+
+  #
+  # Cast the value to the same type of the default setting (if any)
+  #
+  def __cast( self, key, value ):
+    default = self.defaults.get(key)
+    if default is None or value is None or isinstance(value, type(default)):
+      return value
+    if isinstance(default, (dict, list)):
+      return json.loads(value)
+    return type(default)(value)
+
+
+  def __getitem__( self, key ):
+    self.__update()
+    env = os.environ.get( 'ORCHESTRA_' + key.upper() )
+    if env is not None:
+      return self.__cast( key, env )
+    if key in self.__data:
+      return self.__cast( key, self.__data[key] )
+    return self.defaults[key]
+
+
+  def __contains__( self, key ):
+    try:
+      self[key]
+      return True
+    except KeyError:
+      return False
+
+
+  def get( self, key, default=None ):
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+
+# The process wide configuration
+__config = Config()
+
+
+def getConfig():
+  return __config
 
 
 
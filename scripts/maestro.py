@@ -1,15 +1,5 @@
 #!/usr/bin/env python3
 
-try:
-  # in case we have root installed here
-  import ROOT
-  from ROOT import gROOT
-  ROOT.PyConfig.IgnoreCommandLineOptions = True
-  gROOT.SetBatch()
-except:
-  pass
-
-
 import sys, os
 import argparse
 from orchestra.db import OrchestraDB
@@ -23,7 +13,7 @@ commands = parser.add_subparsers(dest='mode')
 
 config = getConfig()
 
-# create the database manager
+# create the database manager (the connection is only opened when a command needs it)
 db  = OrchestraDB( config['postgres'] )
 
 
@@ -96,7 +96,9 @@ except Exception as e:
   subject = "[Cluster LPS] (ALARM) Orchestra stop"
   message=traceback.format_exc()
   for user in db.getAllUsers():
-    postman.send( user.email,subject,message)
+    postman.send( user.email,subject,message, kind='alarm')
   print(message)
+  # wait for the delivery before exit
+  postman.finalize()
 
 